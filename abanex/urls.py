@@ -8,9 +8,17 @@ router = routers.DefaultRouter()
 router.register(r"users", views.UserViewSet)
 router.register(r"currencies", views.CurrencyViewSet)
 router.register(r"buy", views.Buy, basename="buy")
+router.register(r"quote", views.QuoteViewSet, basename="quote")
+router.register(r"token", views.TokenViewSet, basename="token")
+router.register(r"orders", views.OrderViewSet, basename="order")
+router.register(r"portfolio", views.PortfolioViewSet, basename="portfolio")
+router.register(r"treasury", views.TreasuryViewSet, basename="treasury")
+router.register(r"export", views.ExportViewSet, basename="export")
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("buy/async/", views.buy_async, name="buy-async"),
+    path("metrics", views.metrics_view, name="metrics"),
 ] + [
     path("", include(router.urls)),
     path("api-auth/", include("rest_framework.urls", namespace="rest_framework")),
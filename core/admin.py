@@ -1,18 +1,123 @@
+from decimal import Decimal
+
 from django.contrib import admin
-from core.models import UserBalance, TreasuryBalance, Currency, Exchange
+from django.db import transaction
+from django.db.models import OuterRef
+from core.models import (
+    UserBalance,
+    TreasuryBalance,
+    TreasuryDemand,
+    Currency,
+    Exchange,
+    ExchangeCommand,
+    IdempotencyKey,
+    LedgerEntry,
+    Order,
+)
+
+
+@admin.register(Exchange)
+class ExchangeAdmin(admin.ModelAdmin):
+    list_display = ("title", "adapter", "url")
 
-admin.site.register(Exchange)
 
 @admin.register(Currency)
 class CurrencyAdmin(admin.ModelAdmin):
-    list_display = ("ticker_symbol", "display_name", "dollar_value")
+    list_display = (
+        "ticker_symbol",
+        "display_name",
+        "dollar_value",
+        "treasury_threshold",
+    )
+
+
+@admin.register(TreasuryDemand)
+class TreasuryDemandAdmin(admin.ModelAdmin):
+    list_display = ("currency", "rate", "observed_at")
+    readonly_fields = ("currency", "rate", "last_entry_id", "observed_at")
+
+
+class BalanceAdmin(admin.ModelAdmin):
+    """Balances whose edits are recorded in the ledger, see `adjust`."""
+
+    # Fields naming the account, fixed once the balance exists
+    account_fields = ()
+
+    def get_readonly_fields(self, request, obj=None):
+        return self.account_fields if obj else ()
+
+    # Set the amount to 0 instead, so the ledger records it
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            previous = (
+                type(obj)
+                .objects.select_for_update()
+                .filter(pk=obj.pk)
+                .values_list("amount", flat=True)
+                .first()
+            )
+            obj.adjust(previous or Decimal(0))
 
 
 @admin.register(UserBalance)
-class UserBalanceAdmin(admin.ModelAdmin):
+class UserBalanceAdmin(BalanceAdmin):
     list_display = ("user", "currency", "amount")
+    account_fields = ("user", "currency")
 
 
 @admin.register(TreasuryBalance)
-class TreasuryBalanceAdmin(admin.ModelAdmin):
-    list_display = ("currency", "amount")
+class TreasuryBalanceAdmin(BalanceAdmin):
+    list_display = ("currency", "amount", "currency_total")
+    ordering = ("currency",)
+    account_fields = ("currency",)
+
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("currency")
+            .annotate(
+                currency_total=TreasuryBalance.holding(currency=OuterRef("currency"))
+            )
+        )
+
+    @admin.display(description="Currency total", ordering="currency_total")
+    def currency_total(self, obj):
+        return obj.currency_total
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ("id", "user", "currency", "amount", "status", "created_at")
+    list_filter = ("status",)
+
+
+@admin.register(ExchangeCommand)
+class ExchangeCommandAdmin(admin.ModelAdmin):
+    list_display = ("id", "currency", "status", "attempts", "created_at", "error")
+    list_filter = ("status",)
+
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ("key", "user", "status_code", "created_at", "expires_at")
+    search_fields = ("key",)
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "user", "currency", "amount")
+    list_filter = ("currency",)
+
+    # The ledger is append-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
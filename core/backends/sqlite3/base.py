@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite, tuned for concurrent writers.
+
+    Transactions take the write lock when they start (`BEGIN IMMEDIATE`), so
+    a busy database makes them wait for `SQLITE_BUSY_TIMEOUT` instead of
+    failing with "database is locked" when a reading transaction tries to
+    write. Connection PRAGMAs are applied in `core.signals`.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f"BEGIN {settings.SQLITE_TRANSACTION_MODE}")
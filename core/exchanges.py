@@ -0,0 +1,228 @@
+"""Clients for the exchanges the treasury buys from.
+
+`Exchange.client` picks one by the exchange's `adapter`: `SimulatedExchange`
+fills every order on the spot, `HTTPExchange` places it with an exchange's
+HTTP API (see `core.mock_exchange` for a local stand-in).
+"""
+
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from core import metrics
+
+
+class ExchangeError(Exception):
+    """The exchange did not fill the order."""
+
+
+class ExchangeUnavailable(ExchangeError):
+    """The circuit breaker is open, the exchange was not called."""
+
+
+class SimulatedExchange:
+    """Fills every order in full, after `latency` seconds."""
+
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency
+
+    def buy(self, symbol: str, amount: Decimal, client_order_id: str = None) -> Decimal:
+        """Places a market order, returns the filled amount."""
+        if self.latency:
+            time.sleep(self.latency)
+        return amount
+
+
+class CircuitBreaker:
+    """Stops calling an exchange that keeps failing.
+
+    After `threshold` consecutive failures the breaker opens and calls are
+    refused for `reset_timeout` seconds. Then a single call is let through: a
+    success closes the breaker, a failure keeps it open for another period.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_timeout:
+                return False
+            # Half open, the next caller probes while everyone else waits
+            self.opened_at = self.clock()
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+class HTTPExchange:
+    """Places orders with `POST <url>/orders`, over pooled keep-alive connections.
+
+    Every attempt is bounded by `timeout`. Failed attempts (network errors and
+    5xx responses) are retried up to `retries` times, each after a random
+    delay of up to `backoff` seconds, doubling per retry ("full jitter"). So
+    many clients don't retry in lockstep. All attempts carry
+    the same `client_order_id`, so the exchange fills a retried order once.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = None,
+        retries: int = None,
+        backoff: float = None,
+        pool_size: int = None,
+        breaker: CircuitBreaker = None,
+        sleep=time.sleep,
+    ) -> None:
+        parts = urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip("/")
+        self.timeout = settings.EXCHANGE_TIMEOUT if timeout is None else timeout
+        self.retries = settings.EXCHANGE_RETRIES if retries is None else retries
+        self.backoff = settings.EXCHANGE_BACKOFF if backoff is None else backoff
+        self.breaker = breaker or CircuitBreaker(
+            settings.EXCHANGE_BREAKER_THRESHOLD, settings.EXCHANGE_BREAKER_RESET
+        )
+        self.sleep = sleep
+        self.random = random.Random()
+        self._pool = queue.LifoQueue(
+            maxsize=settings.EXCHANGE_POOL_SIZE if pool_size is None else pool_size
+        )
+
+    def buy(self, symbol: str, amount: Decimal, client_order_id: str = None) -> Decimal:
+        """Places a market order, returns the filled amount.
+
+        Orders placed with the same `client_order_id` are filled once.
+        """
+        body = {
+            "client_order_id": client_order_id or uuid.uuid4().hex,
+            "symbol": symbol,
+            "amount": str(amount),
+        }
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.sleep(self.random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            if not self.breaker.allow():
+                raise ExchangeUnavailable("Exchange is unavailable.") from error
+
+            started = time.perf_counter()
+            try:
+                response_status, data = self._request("POST", "/orders", body)
+            except (OSError, http.client.HTTPException) as e:
+                response_status, error = None, e
+            outcome = "error" if response_status is None else str(response_status)
+            metrics.EXCHANGE_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, outcome=outcome
+            )
+
+            if response_status is None or response_status >= 500:
+                if response_status is not None:
+                    error = ExchangeError(f"HTTP {response_status}: {data}")
+                self.breaker.failure()
+                continue
+            # The exchange answered, even if it turned the order down
+            self.breaker.success()
+            if response_status != 200:
+                raise ExchangeError(f"Order rejected: {data}")
+            return Decimal(json.loads(data)["filled"])
+
+        raise ExchangeError(
+            f"Order failed after {self.retries + 1} attempts"
+        ) from error
+
+    def _request(self, method: str, path: str, body: dict) -> tuple:
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = self.connection_class(
+                self.host, self.port, timeout=self.timeout
+            )
+        try:
+            connection.request(
+                method,
+                self.path + path,
+                body=json.dumps(body),
+                headers={"Content-Type": "application/json"},
+            )
+            response = connection.getresponse()
+            data = response.read().decode()
+        except BaseException:
+            # The connection is in an unknown state, don't reuse it
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._pool.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, data
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+ADAPTERS = {
+    "simulated": lambda exchange: SimulatedExchange(),
+    "http": lambda exchange: HTTPExchange(exchange.url),
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(exchange):
+    """The client of `exchange`, shared by the threads of a process.
+
+    Sharing is what lets connections and breaker state outlive a single order.
+    """
+    key = (exchange.pk, exchange.adapter, exchange.url)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = ADAPTERS[exchange.adapter](exchange)
+    return client
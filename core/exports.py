@@ -0,0 +1,89 @@
+"""Full dumps of balances and transfers, streamed a chunk of rows at a time.
+
+Served by `ExportViewSet` and written by `manage.py export`; memory use
+doesn't depend on the number of rows.
+"""
+
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from core.models import Currency, LedgerEntry, TreasuryBalance, UserBalance
+
+
+class Export:
+    """A dataset: the `fields` (name -> lookup) of every row of `queryset`."""
+
+    def __init__(self, queryset, fields: dict) -> None:
+        self.queryset = queryset
+        self.fields = fields
+
+    def rows(self, chunk_size: int = None):
+        """Yields tuples of values, fetching `chunk_size` rows at a time.
+
+        Related fields are joined in, as `select_related` would, but no model
+        instance is built per row.
+        """
+        return (
+            self.queryset.order_by("pk")
+            .values_list(*self.fields.values())
+            .iterator(chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE)
+        )
+
+
+EXPORTS = {
+    "balances": Export(
+        UserBalance.objects.all(),
+        {
+            "id": "id",
+            "user_id": "user_id",
+            "username": "user__username",
+            "currency": "currency__ticker_symbol",
+            "amount": "amount",
+        },
+    ),
+    # Holdings per currency, the rows lag behind the ledger, see TreasuryBalance
+    "treasury": Export(
+        Currency.objects.annotate(amount=TreasuryBalance.holding()),
+        {"currency": "ticker_symbol", "amount": "amount"},
+    ),
+    # Every balance change, an empty user is the treasury
+    "transfers": Export(
+        LedgerEntry.objects.all(),
+        {
+            "id": "id",
+            "created_at": "created_at",
+            "user_id": "user_id",
+            "username": "user__username",
+            "currency": "currency__ticker_symbol",
+            "amount": "amount",
+        },
+    ),
+}
+
+
+def gzip_stream(chunks, level: int = 6):
+    """Gzips a stream of str or bytes chunks.
+
+    Every chunk is flushed, so the client gets rows as soon as they are read
+    rather than once the compressor's buffer fills up.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+async def aiterate(chunks):
+    """Iterates `chunks` from async code, reading one chunk at a time in a thread.
+
+    Under ASGI Django reads a sync iterator whole before sending any of it.
+    Chunks are read on the thread that owns the database connection.
+    """
+    chunks = iter(chunks)
+    done = object()
+    while (chunk := await sync_to_async(next)(chunks, done)) is not done:
+        yield chunk
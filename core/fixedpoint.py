@@ -0,0 +1,74 @@
+"""Fixed-point amounts, stored as integer micro-units.
+
+In python an amount is a `Decimal` with `PLACES` decimal places, in the
+database it is the integer `amount * 10**PLACES`. Comparisons and
+`F("amount") + x` updates are therefore integer operations in SQL.
+"""
+
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from django import forms
+from django.core import exceptions
+from django.db import models
+
+PLACES = 6
+SCALE = 10**PLACES
+QUANTUM = Decimal(1).scaleb(-PLACES)
+
+
+def to_units(value) -> int:
+    """Converts an amount to micro-units, rounding half to even."""
+    if isinstance(value, int):
+        return value * SCALE
+    if isinstance(value, float):
+        value = repr(value)
+    return int(Decimal(value).scaleb(PLACES).to_integral_value(ROUND_HALF_EVEN))
+
+
+def from_units(units: int) -> Decimal:
+    return Decimal(units).scaleb(-PLACES).quantize(QUANTUM)
+
+
+def quantize(value) -> Decimal:
+    """Rounds an amount to the precision it can be stored with."""
+    return from_units(to_units(value))
+
+
+class MicroAmountField(models.BigIntegerField):
+    """A `Decimal` amount stored as a `BIGINT` of micro-units."""
+
+    description = "Fixed-point amount, stored as integer micro-units"
+    decimal_places = PLACES
+    max_digits = 19
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return from_units(value)
+
+    def to_python(self, value):
+        if value is None:
+            return value
+        try:
+            return quantize(value)
+        except (ArithmeticError, ValueError, TypeError):
+            raise exceptions.ValidationError(
+                self.error_messages["invalid"],
+                code="invalid",
+                params={"value": value},
+            )
+
+    def get_prep_value(self, value):
+        if value is None or hasattr(value, "resolve_expression"):
+            return value
+        return to_units(value)
+
+    def formfield(self, **kwargs):
+        return super().formfield(
+            **{
+                "form_class": forms.DecimalField,
+                "decimal_places": self.decimal_places,
+                "max_digits": self.max_digits,
+                **kwargs,
+            }
+        )
@@ -0,0 +1,265 @@
+import json
+import random
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.models import Currency, Exchange, TreasuryBalance, UserBalance
+
+User = get_user_model()
+
+
+def percentile(values: list, percent: float) -> float:
+    """Nearest-rank percentile of already sorted `values`."""
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def load_requests(path: str) -> list:
+    """Reads a request log, one JSON object per line.
+
+    Each line looks like `{"request_id": ..., "method": "POST", "path": "/buy/",
+    "body": {"symbol": "BTC", "amount": "0.1"}}`; `method` and `path` default to
+    a buy, and `body` may also be a JSON encoded string.
+    """
+    requests = []
+    with open(path) as log:
+        for line in log:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = request.get("body", {})
+            if isinstance(body, str):
+                body = json.loads(body)
+            requests.append(
+                {
+                    "request_id": request.get("request_id"),
+                    "method": request.get("method", "POST").upper(),
+                    "path": request.get("path", "/buy/"),
+                    "body": body,
+                }
+            )
+    return requests
+
+
+class Benchmark:
+    """Seeds users and currencies, then replays requests against them."""
+
+    def __init__(self, users: int, currencies: int, seed: int = 0) -> None:
+        self.random = random.Random(seed)
+        self.user_count = users
+        self.currency_count = currencies
+        self.users = []
+        self.symbols = []
+
+    def seed(self) -> None:
+        base_currency, _ = Currency.objects.get_or_create(
+            ticker_symbol=settings.BASE_CURRENCY_SYMBOL,
+            defaults={"display_name": "US Dollar", "dollar_value": 1},
+        )
+        currencies = Currency.objects.bulk_create(
+            [
+                Currency(
+                    display_name=f"Benchmark {i}",
+                    ticker_symbol=f"BN{i}",
+                    dollar_value=Decimal(self.random.randint(1, 1000)),
+                )
+                for i in range(self.currency_count)
+            ]
+        )
+        self.users = User.objects.bulk_create(
+            [
+                User(username=f"benchmark-{i}", password=make_password(None))
+                for i in range(self.user_count)
+            ]
+        )
+        UserBalance.objects.bulk_create(
+            [
+                UserBalance(user=user, currency=base_currency, amount=10**6)
+                for user in self.users
+            ]
+        )
+        TreasuryBalance.objects.bulk_create(
+            [
+                TreasuryBalance(currency=currency, amount=10**6)
+                for currency in currencies
+            ]
+        )
+        if not Exchange.objects.exists():
+            Exchange.objects.create(title="Benchmark")
+        self.symbols = [currency.ticker_symbol for currency in currencies]
+
+    def generate_requests(self, count: int) -> list:
+        return [
+            {
+                "request_id": f"generated-{i}",
+                "method": "POST",
+                "path": "/buy/",
+                "body": {
+                    "symbol": self.random.choice(self.symbols),
+                    "amount": str(Decimal(self.random.randint(1, 1000)) / 1000),
+                },
+            }
+            for i in range(count)
+        ]
+
+    def run(self, requests: list, concurrency: int) -> dict:
+        """Replays `requests` from `concurrency` threads and returns the stats."""
+        local = threading.local()
+        chunks = [requests[i::concurrency] for i in range(concurrency)]
+        samples = []
+        lock_errors = []
+        lock = threading.Lock()
+
+        def count_queries(execute, sql, params, many, context):
+            local.queries += 1
+            try:
+                return execute(sql, params, many, context)
+            except OperationalError as e:
+                if "locked" in str(e):
+                    local.lock_errors += 1
+                raise
+
+        def replay(chunk: list) -> None:
+            client = Client()
+            client.force_login(self.random.choice(self.users))
+            local.lock_errors = 0
+            results = []
+            try:
+                with connection.execute_wrapper(count_queries):
+                    for request in chunk:
+                        local.queries = 0
+                        started = time.perf_counter()
+                        response = client.generic(
+                            request["method"],
+                            request["path"],
+                            json.dumps(request["body"]),
+                            content_type="application/json",
+                        )
+                        results.append(
+                            (
+                                time.perf_counter() - started,
+                                local.queries,
+                                response.status_code,
+                            )
+                        )
+            finally:
+                if concurrency > 1:
+                    connection.close()
+            with lock:
+                samples.extend(results)
+                lock_errors.append(local.lock_errors)
+
+        started = time.perf_counter()
+        if concurrency == 1:
+            replay(chunks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(replay, chunks))
+        duration = time.perf_counter() - started
+
+        latencies = sorted(sample[0] * 1000 for sample in samples)
+        queries = sum(sample[1] for sample in samples)
+        return {
+            "requests": len(samples),
+            "concurrency": concurrency,
+            "duration_seconds": round(duration, 4),
+            "requests_per_second": round(len(samples) / duration, 2) if duration else 0,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50), 3),
+                "p95": round(percentile(latencies, 95), 3),
+                "p99": round(percentile(latencies, 99), 3),
+                "max": round(latencies[-1], 3) if latencies else 0,
+            },
+            "queries_per_request": round(queries / len(samples), 2) if samples else 0,
+            "lock_errors": sum(lock_errors),
+            "status_codes": dict(Counter(str(sample[2]) for sample in samples)),
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the buy path on a throwaway database and prints the results "
+        "as JSON, so runs can be compared across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--currencies", type=int, default=10)
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=1000,
+            help="Number of buys to generate, ignored with --replay.",
+        )
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument(
+            "--replay",
+            help="JSONL request log to replay instead of generated buys.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--database-file",
+            help="SQLite file to run on, defaults to a temporary file. An in-memory "
+            "database can't be shared by threads without table locks.",
+        )
+        parser.add_argument("--output", help="Write the results to this file.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == "sqlite":
+            connection.settings_dict["TEST"]["NAME"] = options[
+                "database_file"
+            ] or os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            benchmark = Benchmark(
+                users=options["users"],
+                currencies=options["currencies"],
+                seed=options["seed"],
+            )
+            benchmark.seed()
+            if options["replay"]:
+                requests = load_requests(options["replay"])
+            else:
+                requests = benchmark.generate_requests(options["requests"])
+            results = benchmark.run(requests, concurrency=options["concurrency"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        results["commit"] = self.current_commit()
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        self.stdout.write(output)
+
+    def current_commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                text=True,
+                cwd=settings.BASE_DIR,
+            ).stdout.strip()
+        except OSError:
+            return None
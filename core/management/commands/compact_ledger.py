@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.models import LedgerSnapshot
+
+
+class Command(BaseCommand):
+    help = "Rolls the ledger snapshots forward, so balance reads stay cheap."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=None,
+            help="Only include entries older than this many seconds.",
+        )
+
+    def handle(self, *args, **options):
+        last_entry_id = LedgerSnapshot.compact(older_than=options["older_than"])
+        self.stdout.write(f"Snapshots include ledger entries up to #{last_entry_id}")
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Exchange
+from core.utils import OutboxDispatcher
+
+
+class Command(BaseCommand):
+    help = "Settles treasury debt recorded by buys in the exchange command outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Commands claimed at once, defaults to OUTBOX_BATCH_SIZE.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0.5,
+            help="Seconds to wait when there are no commands due.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Dispatch the commands that are due and exit.",
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = OutboxDispatcher(
+            exchange=Exchange.objects.get(), batch_size=options["batch_size"]
+        )
+        if options["once"]:
+            dispatched = 0
+            while count := dispatcher.process_batch():
+                dispatched += count
+            self.stdout.write(f"Dispatched {dispatched} commands")
+            return
+        self.stdout.write("Dispatching exchange commands, press CTRL-C to stop.")
+        try:
+            dispatcher.run_forever(poll_interval=options["interval"])
+        except KeyboardInterrupt:
+            pass
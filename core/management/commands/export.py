@@ -0,0 +1,47 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from core.exports import EXPORTS, gzip_stream
+from core.renderers import CSVRenderer, JSONLinesRenderer
+
+RENDERERS = {renderer.format: renderer for renderer in (JSONLinesRenderer, CSVRenderer)}
+
+
+class Command(BaseCommand):
+    help = "Writes every balance, treasury balance or transfer as JSON lines or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument("export", choices=sorted(EXPORTS))
+        parser.add_argument("--format", choices=sorted(RENDERERS), default="jsonl")
+        parser.add_argument(
+            "--output", help="File to write to, defaults to standard output."
+        )
+        parser.add_argument("--gzip", action="store_true", help="Gzip the output.")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=None,
+            help="Rows fetched at a time, defaults to EXPORT_CHUNK_SIZE.",
+        )
+
+    def handle(self, *args, **options):
+        export = EXPORTS[options["export"]]
+        renderer = RENDERERS[options["format"]]()
+        chunks = renderer.stream(
+            list(export.fields), export.rows(chunk_size=options["chunk_size"])
+        )
+        if options["gzip"]:
+            chunks = gzip_stream(chunks)
+        else:
+            chunks = (chunk.encode(renderer.charset) for chunk in chunks)
+
+        output = (
+            open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        )
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options["output"]:
+                output.close()
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from core.mock_exchange import MockExchangeServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a local stand-in for an exchange's HTTP API, point an exchange "
+        "with the HTTP adapter at it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Seconds every order takes.",
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0,
+            help="Share of requests answered with 503, between 0 and 1.",
+        )
+        parser.add_argument("--seed", type=int, default=None)
+
+    def handle(self, *args, **options):
+        server = MockExchangeServer(
+            host=options["host"],
+            port=options["port"],
+            latency=options["latency"],
+            failure_rate=options["failure_rate"],
+            seed=options["seed"],
+            verbose=options["verbosity"] > 1,
+        )
+        self.stdout.write(f"Mock exchange on {server.url}, press CTRL-C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Exchange
+from core.utils import OrderProcessor
+
+
+class Command(BaseCommand):
+    help = "Fills pending orders in batches, many orders per transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Orders per transaction, defaults to ORDER_BATCH_SIZE.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0.1,
+            help="Seconds to wait when there are no pending orders.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process the pending orders and exit.",
+        )
+
+    def handle(self, *args, **options):
+        processor = OrderProcessor(
+            exchange=Exchange.objects.get(), batch_size=options["batch_size"]
+        )
+        if options["once"]:
+            processed = 0
+            while count := processor.process_batch():
+                processed += count
+            self.stdout.write(f"Processed {processed} orders")
+            return
+        self.stdout.write("Processing orders, press CTRL-C to stop.")
+        try:
+            processor.run_forever(poll_interval=options["interval"])
+        except KeyboardInterrupt:
+            pass
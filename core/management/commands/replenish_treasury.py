@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Exchange
+from core.utils import TreasuryReplenisher
+
+
+class Command(BaseCommand):
+    help = "Settles treasury debt by placing aggregated orders on the exchange."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between two debt checks.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Check once and exit, eg. when run from cron.",
+        )
+
+    def handle(self, *args, **options):
+        replenisher = TreasuryReplenisher(exchange=Exchange.objects.get())
+        if options["once"]:
+            for symbol, amount in replenisher.run_once():
+                self.stdout.write(f"Bought {amount} {symbol}")
+            return
+        self.stdout.write("Replenishing treasury, press CTRL-C to stop.")
+        try:
+            replenisher.run_forever(poll_interval=options["interval"])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,232 @@
+import random
+import string
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from core.fixedpoint import from_units, to_units
+from core.models import (
+    Currency,
+    LedgerEntry,
+    PriceVersion,
+    UserBalance,
+    currency_cache,
+)
+
+User = get_user_model()
+
+DIGITS = string.digits + string.ascii_uppercase
+
+
+def base36(number: int) -> str:
+    digits = ""
+    while True:
+        number, digit = divmod(number, 36)
+        digits = DIGITS[digit] + digits
+        if not number:
+            return digits
+
+
+class Seeder:
+    """Generates users, currencies and their balances for load tests.
+
+    Users and currencies are written with `bulk_create`, `chunk_size` users
+    at a time, each chunk with its balances and opening ledger entries in a
+    transaction of its own, so memory use doesn't grow with the dataset.
+    The same `seed` always generates the same prices and amounts.
+    """
+
+    def __init__(
+        self,
+        users: int,
+        currencies: int,
+        holdings: int = 3,
+        seed: int = 0,
+        chunk_size: int = 5000,
+        prefix: str = "seed",
+        password: str = None,
+    ) -> None:
+        self.random = random.Random(seed)
+        self.user_count = users
+        self.currency_count = currencies
+        self.holdings = min(holdings, currencies)
+        self.chunk_size = chunk_size
+        self.prefix = prefix
+        # Hashing is slow on purpose, every user shares the same hash
+        self.password = make_password(password)
+        self.rows = Counter()
+
+    def symbol(self, index: int) -> str:
+        symbol = (self.prefix[:2] + base36(index)).upper()
+        if len(symbol) > Currency._meta.get_field("ticker_symbol").max_length:
+            raise ValueError(f"Too many currencies for the prefix {self.prefix!r}.")
+        return symbol
+
+    def run(self, progress=None) -> Counter:
+        """Writes the dataset, returns the number of rows per model."""
+        self.connection = connections[router.db_for_write(LedgerEntry)]
+        self.created_at = LedgerEntry._meta.get_field("created_at").get_db_prep_save(
+            timezone.now(), self.connection
+        )
+        with transaction.atomic():
+            self.base_currency, _ = Currency.objects.get_or_create(
+                ticker_symbol=settings.BASE_CURRENCY_SYMBOL,
+                defaults={"display_name": "US Dollar", "dollar_value": 1},
+            )
+            self.currencies = self._create(Currency, self._currencies())
+            # Only in the ledger, compact_ledger folds them into TreasuryBalance
+            self._open(self._treasury_holdings())
+        # bulk_create doesn't send signals, see `stamp_price_version`
+        currency_cache.clear()
+
+        for start in range(0, self.user_count, self.chunk_size):
+            end = min(start + self.chunk_size, self.user_count)
+            with transaction.atomic():
+                users = self._create(
+                    User,
+                    [
+                        User(username=f"{self.prefix}-{i}", password=self.password)
+                        for i in range(start, end)
+                    ],
+                )
+                balances = self._user_balances(users)
+                self._insert(UserBalance, ["user", "currency", "amount"], balances)
+                self._open(balances)
+            if progress:
+                progress(end)
+        return self.rows
+
+    def _create(self, model, objects: list) -> list:
+        created = model.objects.bulk_create(objects, batch_size=self.chunk_size)
+        self.rows[model._meta.label] += len(created)
+        return created
+
+    def _insert(self, model, fields: list, rows: list) -> None:
+        """`bulk_create` for rows of database values, as one prepared INSERT.
+
+        Balances and ledger entries are most of the rows; building and
+        compiling a model instance for each costs about ten times as much as
+        inserting it.
+        """
+        quote = self.connection.ops.quote_name
+        columns = [model._meta.get_field(field).column for field in fields]
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            quote(model._meta.db_table),
+            ", ".join(quote(column) for column in columns),
+            ", ".join(["%s"] * len(columns)),
+        )
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        self.rows[model._meta.label] += len(rows)
+
+    def _open(self, balances: list) -> None:
+        """Writes the ledger entries opening (user, currency, units) `balances`."""
+        self._insert(
+            LedgerEntry,
+            ["user", "currency", "amount", "created_at"],
+            [balance + (self.created_at,) for balance in balances],
+        )
+
+    def _currencies(self) -> list:
+        # Tells the other workers that prices changed, once for all of them
+        version = PriceVersion.bump()
+        return [
+            Currency(
+                display_name=f"{self.prefix.title()} {i}",
+                ticker_symbol=self.symbol(i),
+                # Between a cent and a hundred thousand dollars
+                dollar_value=from_units(self.random.randint(10**4, 10**11)),
+                price_version=version,
+            )
+            for i in range(self.currency_count)
+        ]
+
+    def _treasury_holdings(self) -> list:
+        """(no user, currency, units) opening balances of the treasury."""
+        return [
+            (None, currency.pk, to_units(self.random.randint(10**3, 10**6)))
+            for currency in self.currencies
+        ]
+
+    def _user_balances(self, users: list) -> list:
+        """(user, currency, units) rows, the base currency and `holdings` others."""
+        rows = []
+        for user in users:
+            rows.append(
+                (user.pk, self.base_currency.pk, self.random.randint(0, 10**11))
+            )
+            rows += [
+                (user.pk, currency.pk, self.random.randint(1, 10**9))
+                for currency in self.random.sample(self.currencies, self.holdings)
+            ]
+        return rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the database with generated users, currencies and balances, "
+        "for load tests at production sizes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--currencies", type=int, default=100)
+        parser.add_argument(
+            "--holdings",
+            type=int,
+            default=3,
+            help="Currencies each user holds, besides the base currency.",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Same seed, same dataset."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Users written per INSERT and per transaction.",
+        )
+        parser.add_argument(
+            "--prefix",
+            default="seed",
+            help="Usernames are <prefix>-<n>, currencies start with its first "
+            "two letters. Change it to seed a database again.",
+        )
+        parser.add_argument(
+            "--password", help="Password of every user, by default they have none."
+        )
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username=f"{options['prefix']}-0").exists():
+            raise CommandError(
+                f"Already seeded with prefix {options['prefix']!r}, pick another one."
+            )
+        seeder = Seeder(
+            users=options["users"],
+            currencies=options["currencies"],
+            holdings=options["holdings"],
+            seed=options["seed"],
+            chunk_size=options["chunk_size"],
+            prefix=options["prefix"],
+            password=options["password"],
+        )
+        started = time.perf_counter()
+        rows = seeder.run(
+            progress=lambda users: self.stdout.write(
+                f"{users}/{options['users']} users", ending="\r"
+            )
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write("")
+        for label, count in sorted(rows.items()):
+            self.stdout.write(f"{label}: {count} rows")
+        total = sum(rows.values())
+        self.stdout.write(
+            f"Wrote {total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)"
+        )
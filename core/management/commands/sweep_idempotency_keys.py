@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Deletes expired idempotency keys, so the table stays small."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=300.0,
+            help="Seconds to wait between two sweeps.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Sweep once and exit, eg. when run from cron.",
+        )
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            deleted = IdempotencyKey.sweep()
+            self.stdout.write(f"Deleted {deleted} expired keys")
+            return
+        self.stdout.write("Sweeping idempotency keys, press CTRL-C to stop.")
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    IdempotencyKey.sweep()
+                except Exception as e:
+                    print(f"Error: {str(e)}")
+                time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,141 @@
+import bisect
+import threading
+import time
+from contextlib import ContextDecorator
+
+# Upper bounds, in seconds
+DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100)
+
+HISTOGRAMS = []
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels: dict) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # A fresh timer per call, so decorated functions are thread safe
+        return _Timer(self.histogram, self.labels)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Histogram:
+    """A Prometheus style histogram with fixed buckets.
+
+    Observing is a bisect and a few integer increments under a lock. Values are
+    kept per process, so every gunicorn worker exposes its own series.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: tuple) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self._series = {}
+        HISTOGRAMS.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels) -> _Timer:
+        """Observes the time spent in a `with` block or a decorated function."""
+        return _Timer(self, labels)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series = {}
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                labels = _format_labels(key + (("le", bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {values[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", ""))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render() -> str:
+    """All histograms, in the Prometheus text exposition format."""
+    return "\n".join(line for histogram in HISTOGRAMS for line in histogram.render())
+
+
+REQUEST_SECONDS = Histogram(
+    "abanex_request_duration_seconds",
+    "Wall time spent handling a request, per view.",
+    DURATION_BUCKETS,
+)
+SQL_QUERIES = Histogram(
+    "abanex_request_sql_queries",
+    "Number of SQL queries run by a request, per view.",
+    QUERY_COUNT_BUCKETS,
+)
+SQL_SECONDS = Histogram(
+    "abanex_request_sql_duration_seconds",
+    "Time a request spent waiting on SQL queries, per view.",
+    DURATION_BUCKETS,
+)
+TRANSFER_SECONDS = Histogram(
+    "abanex_transfer_duration_seconds",
+    "Time spent in TransferHandler, per direction.",
+    DURATION_BUCKETS,
+)
+TREASURY_PURCHASE_SECONDS = Histogram(
+    "abanex_treasury_purchase_duration_seconds",
+    "Time spent settling treasury debt in TreasuryPurchaceHandler.",
+    DURATION_BUCKETS,
+)
+EXCHANGE_REQUEST_SECONDS = Histogram(
+    "abanex_exchange_request_duration_seconds",
+    "Time spent on a single exchange API request, per outcome.",
+    DURATION_BUCKETS,
+)
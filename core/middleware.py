@@ -0,0 +1,71 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from core import metrics
+
+# [query count, seconds] of the request being measured
+_queries = ContextVar("queries", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, see `core.signals`.
+
+    Counts the query against the request measured in this context. Under
+    ASGI, queries run on the connection of a `sync_to_async` thread, which
+    gets a copy of the context, so they are counted too.
+    """
+    queries = _queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Records wall time, SQL query count and SQL time of every request, per view.
+
+    Sync and async capable, so under ASGI async views aren't pushed through a
+    thread just for this middleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with self.measure(request):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with self.measure(request):
+            return await self.get_response(request)
+
+    @contextmanager
+    def measure(self, request):
+        queries = [0, 0.0]
+        token = _queries.set(queries)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            _queries.reset(token)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        metrics.REQUEST_SECONDS.observe(elapsed, view=view)
+        metrics.SQL_QUERIES.observe(queries[0], view=view)
+        metrics.SQL_SECONDS.observe(queries[1], view=view)
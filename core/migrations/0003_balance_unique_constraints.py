@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_delete_debt'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='treasurybalance',
+            constraint=models.UniqueConstraint(fields=('currency',), name='unique_treasury_balance'),
+        ),
+        migrations.AddConstraint(
+            model_name='userbalance',
+            constraint=models.UniqueConstraint(fields=('user', 'currency'), name='unique_user_balance'),
+        ),
+    ]
@@ -0,0 +1,138 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def open_ledger(apps, schema_editor):
+    """Records the existing balances as the opening entries of the ledger."""
+    UserBalance = apps.get_model("core", "UserBalance")
+    TreasuryBalance = apps.get_model("core", "TreasuryBalance")
+    LedgerEntry = apps.get_model("core", "LedgerEntry")
+    db_alias = schema_editor.connection.alias
+
+    entries = [
+        LedgerEntry(
+            user_id=balance.user_id,
+            currency_id=balance.currency_id,
+            amount=balance.amount,
+        )
+        for balance in UserBalance.objects.using(db_alias).exclude(amount=0)
+    ] + [
+        LedgerEntry(currency_id=balance.currency_id, amount=balance.amount)
+        for balance in TreasuryBalance.objects.using(db_alias).exclude(amount=0)
+    ]
+    LedgerEntry.objects.using(db_alias).bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("core", "0004_priceversion"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LedgerSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "amount",
+                    models.DecimalField(
+                        decimal_places=4,
+                        default=0,
+                        max_digits=12,
+                        verbose_name="Currency Amount",
+                    ),
+                ),
+                ("last_entry_id", models.BigIntegerField(default=0)),
+                (
+                    "currency",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, to="core.currency"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="LedgerEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "amount",
+                    models.DecimalField(
+                        decimal_places=4, max_digits=12, verbose_name="Change"
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "currency",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, to="core.currency"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "ledger entries",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="ledgersnapshot",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("user__isnull", False)),
+                fields=("user", "currency"),
+                name="unique_user_snapshot",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="ledgersnapshot",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("user__isnull", True)),
+                fields=("currency",),
+                name="unique_treasury_snapshot",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ledgerentry",
+            index=models.Index(
+                fields=["user", "currency", "id"], name="ledger_account_idx"
+            ),
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
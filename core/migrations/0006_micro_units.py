@@ -0,0 +1,71 @@
+from django.db import migrations, models
+
+import core.fixedpoint
+
+# (model, field, verbose name, default)
+AMOUNT_FIELDS = [
+    ("currency", "dollar_value", "Dollar Value", None),
+    ("userbalance", "amount", "Currency Amount", 0),
+    ("treasurybalance", "amount", "Currency Amount", 0),
+    ("ledgerentry", "amount", "Change", None),
+    ("ledgersnapshot", "amount", "Currency Amount", 0),
+]
+
+
+def to_micro_units(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    for model_name, field, _, _ in AMOUNT_FIELDS:
+        model = apps.get_model("core", model_name)
+        rows = list(model.objects.using(db_alias).only("pk", field))
+        for row in rows:
+            setattr(
+                row, f"{field}_units", core.fixedpoint.to_units(getattr(row, field))
+            )
+        model.objects.using(db_alias).bulk_update(
+            rows, [f"{field}_units"], batch_size=1000
+        )
+
+
+def add_units_fields():
+    return [
+        migrations.AddField(
+            model_name=model_name,
+            name=f"{field}_units",
+            field=models.BigIntegerField(default=0),
+        )
+        for model_name, field, _, _ in AMOUNT_FIELDS
+    ]
+
+
+def replace_fields():
+    operations = []
+    for model_name, field, verbose_name, default in AMOUNT_FIELDS:
+        kwargs = {} if default is None else {"default": default}
+        operations += [
+            migrations.RemoveField(model_name=model_name, name=field),
+            migrations.RenameField(
+                model_name=model_name, old_name=f"{field}_units", new_name=field
+            ),
+            migrations.AlterField(
+                model_name=model_name,
+                name=field,
+                field=core.fixedpoint.MicroAmountField(verbose_name, **kwargs),
+            ),
+        ]
+    return operations
+
+
+class Migration(migrations.Migration):
+    """Stores amounts and prices as integer micro-units.
+
+    Values are copied through a new column, so no database has to cast a
+    decimal column to an integer one. There is no way back.
+    """
+
+    dependencies = [
+        ("core", "0005_ledger"),
+    ]
+
+    operations = (
+        add_units_fields() + [migrations.RunPython(to_micro_units)] + replace_fields()
+    )
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_order"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="treasurybalance",
+            name="unique_treasury_balance",
+        ),
+        migrations.AddField(
+            model_name="treasurybalance",
+            name="stripe",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name="treasurybalance",
+            constraint=models.UniqueConstraint(
+                fields=("currency", "stripe"), name="unique_treasury_stripe"
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+# The user model belongs to another app, so its index is added by hand.
+USER_JOINED_INDEX = models.Index(
+    fields=["date_joined", "id"], name="core_user_joined_idx"
+)
+
+
+def add_user_index(apps, schema_editor):
+    schema_editor.add_index(
+        apps.get_model(settings.AUTH_USER_MODEL), USER_JOINED_INDEX
+    )
+
+
+def remove_user_index(apps, schema_editor):
+    schema_editor.remove_index(
+        apps.get_model(settings.AUTH_USER_MODEL), USER_JOINED_INDEX
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("core", "0009_idempotency_key"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(fields=["user", "id"], name="order_user_idx"),
+        ),
+        migrations.RunPython(add_user_index, remove_user_index),
+    ]
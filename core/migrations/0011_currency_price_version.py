@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0010_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="currency",
+            name="price_version",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
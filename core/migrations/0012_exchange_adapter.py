@@ -0,0 +1,27 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0011_currency_price_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="exchange",
+            name="adapter",
+            field=models.CharField(
+                choices=[("simulated", "Simulated"), ("http", "HTTP API")],
+                default="simulated",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="exchange",
+            name="url",
+            field=models.URLField(blank=True, verbose_name="API URL"),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:52
+
+import core.fixedpoint
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0013_exchange_command"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TreasuryDemand",
+            fields=[
+                (
+                    "currency",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="core.currency",
+                    ),
+                ),
+                ("rate", models.FloatField(default=0)),
+                ("last_entry_id", models.BigIntegerField(default=0)),
+                ("observed_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name="currency",
+            name="treasury_threshold",
+            field=core.fixedpoint.MicroAmountField(
+                blank=True, null=True, verbose_name="Treasury threshold (USD)"
+            ),
+        ),
+    ]
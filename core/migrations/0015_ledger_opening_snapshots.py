@@ -0,0 +1,60 @@
+from django.db import migrations
+from django.db.models import Max, Sum
+
+
+def snapshot_ledger(apps, schema_editor):
+    """Snapshots every account as of the last ledger entry.
+
+    The treasury's entries so far are already counted in `TreasuryBalance`:
+    the opening entries of 0005 copy its rows, and buys used to update the
+    rows as well as the ledger. Moving the compaction watermark past them
+    keeps `TreasuryBalance.holding` from counting them a second time, while
+    the snapshots keep `LedgerEntry.balance_of` where it was.
+    """
+    LedgerEntry = apps.get_model("core", "LedgerEntry")
+    LedgerSnapshot = apps.get_model("core", "LedgerSnapshot")
+    db_alias = schema_editor.connection.alias
+    entries = LedgerEntry.objects.using(db_alias)
+    snapshots = LedgerSnapshot.objects.using(db_alias)
+
+    upto = entries.aggregate(last=Max("id"))["last"]
+    if upto is None:
+        return
+    previous = snapshots.aggregate(last=Max("last_entry_id"))["last"]
+    existing = {
+        (snapshot.user_id, snapshot.currency_id): snapshot for snapshot in snapshots
+    }
+    deltas = (
+        entries.filter(id__gt=previous or 0)
+        .values_list("user_id", "currency_id")
+        .annotate(total=Sum("amount"))
+        .order_by()
+    )
+    created = []
+    for user_id, currency_id, total in deltas:
+        snapshot = existing.get((user_id, currency_id))
+        if snapshot is None:
+            created.append(
+                LedgerSnapshot(
+                    user_id=user_id,
+                    currency_id=currency_id,
+                    amount=total,
+                    last_entry_id=upto,
+                )
+            )
+        else:
+            snapshot.amount += total
+    snapshots.bulk_update(existing.values(), ["amount"], batch_size=1000)
+    snapshots.bulk_create(created, batch_size=1000)
+    snapshots.update(last_entry_id=upto)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_treasury_demand"),
+    ]
+
+    operations = [
+        migrations.RunPython(snapshot_ledger, migrations.RunPython.noop),
+    ]
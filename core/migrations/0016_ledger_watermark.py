@@ -0,0 +1,43 @@
+# Generated by Django 4.2.5 on 2026-10-17 22:45
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def copy_watermark(apps, schema_editor):
+    """Starts from the last entry compacted so far, the snapshots' highest."""
+    LedgerSnapshot = apps.get_model("core", "LedgerSnapshot")
+    LedgerWatermark = apps.get_model("core", "LedgerWatermark")
+    db_alias = schema_editor.connection.alias
+    last_entry_id = LedgerSnapshot.objects.using(db_alias).aggregate(
+        last=Max("last_entry_id")
+    )["last"]
+    LedgerWatermark.objects.using(db_alias).create(
+        pk=1, last_entry_id=last_entry_id or 0
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0015_ledger_opening_snapshots"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LedgerWatermark",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_entry_id", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(copy_watermark, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-17 22:47
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def fold_stripes(apps, schema_editor):
+    """Adds every stripe of a currency into stripe 0, and deletes the others."""
+    TreasuryBalance = apps.get_model("core", "TreasuryBalance")
+    balances = TreasuryBalance.objects.using(schema_editor.connection.alias)
+    totals = (
+        balances.filter(stripe__gt=0)
+        .values_list("currency")
+        .annotate(total=Sum("amount"))
+        .order_by()
+    )
+    for currency_id, total in totals:
+        balance, _ = balances.get_or_create(currency_id=currency_id, stripe=0)
+        balance.amount += total
+        balance.save(update_fields=["amount"])
+    balances.filter(stripe__gt=0).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0016_ledger_watermark"),
+    ]
+
+    operations = [
+        migrations.RunPython(fold_stripes, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name="treasurybalance",
+            name="unique_treasury_stripe",
+        ),
+        migrations.RemoveField(
+            model_name="treasurybalance",
+            name="stripe",
+        ),
+        migrations.AddConstraint(
+            model_name="treasurybalance",
+            constraint=models.UniqueConstraint(
+                fields=("currency",), name="unique_treasury_balance"
+            ),
+        ),
+    ]
@@ -0,0 +1,103 @@
+"""A local stand-in for an exchange's HTTP API, see `core.exchanges.HTTPExchange`.
+
+`POST /orders` with `{"client_order_id": ..., "symbol": ..., "amount": ...}`
+fills the order in full and answers `{"filled": amount, ...}`. Orders are
+remembered by `client_order_id`, so a retried order is filled once. Latency
+and a rate of `503` failures can be injected to see how clients cope.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockExchangeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like a real exchange
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            order = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.reply(400, {"error": "Invalid JSON."})
+        if self.path.rstrip("/") != "/orders":
+            return self.reply(404, {"error": "Not found."})
+        if not {"client_order_id", "symbol", "amount"} <= set(order):
+            return self.reply(400, {"error": "Missing fields."})
+
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.random.random() < server.failure_rate
+        if server.latency:
+            time.sleep(server.latency)
+        if fail:
+            return self.reply(503, {"error": "Try again later."})
+
+        with server.lock:
+            fill = server.orders.setdefault(
+                order["client_order_id"],
+                {
+                    "client_order_id": order["client_order_id"],
+                    "symbol": order["symbol"],
+                    "filled": order["amount"],
+                },
+            )
+        self.reply(200, fill)
+
+    def reply(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MockExchangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0,
+        failure_rate: float = 0,
+        seed: int = None,
+        verbose: bool = False,
+    ) -> None:
+        super().__init__((host, port), MockExchangeHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        # client_order_id -> fill
+        self.orders = {}
+        self.requests = 0
+        self.connections = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        """Serves from a background thread, eg. in tests."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -1,9 +1,21 @@
+from asgiref.sync import sync_to_async
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.db import transaction
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import ExpressionWrapper, F, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from core.exchanges import get_client
+from core.fixedpoint import MicroAmountField, quantize, to_units
+from collections import OrderedDict
+from datetime import timedelta
 from decimal import Decimal
+from django.utils import timezone
+import threading
+import time
+import uuid
 
 User = get_user_model()
 
@@ -13,7 +25,14 @@ class Currency(models.Model):
 
     display_name = models.CharField(max_length=50)
     ticker_symbol = models.CharField(max_length=6, unique=True)
-    dollar_value = models.DecimalField("Dollar Value", decimal_places=4, max_digits=12)
+    dollar_value = MicroAmountField("Dollar Value")
+    # Treasury debt, in dollars, that is worth an exchange order; defaults to
+    # TREASURY_DEBT_THRESHOLD, see `ReplenishmentPolicy`
+    treasury_threshold = MicroAmountField(
+        "Treasury threshold (USD)", null=True, blank=True
+    )
+    # `PriceVersion` this price was set at
+    price_version = models.PositiveBigIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name_plural = "currencies"
@@ -21,27 +40,195 @@ class Currency(models.Model):
     def __str__(self) -> str:
         return self.ticker_symbol
 
+    def rate(self, other: "Currency") -> Decimal:
+        """Price of one unit in `other`, raises `Currency.DoesNotExist` if `other`
+        has no price."""
+        if not other.dollar_value:
+            raise Currency.DoesNotExist(
+                f"No rate for {self.ticker_symbol} in {other.ticker_symbol}."
+            )
+        return Decimal(self.dollar_value) / Decimal(other.dollar_value)
+
+
+class PriceVersion(models.Model):
+    """Monotonic counter, bumped whenever currency prices change."""
+
+    version = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def current(cls) -> int:
+        return cls.objects.filter(pk=1).values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls) -> int:
+        """Increments the version, returns the new one."""
+        with transaction.atomic():
+            if not cls.objects.filter(pk=1).update(version=F("version") + 1):
+                _, created = cls.objects.get_or_create(pk=1, defaults={"version": 1})
+                if not created:
+                    cls.objects.filter(pk=1).update(version=F("version") + 1)
+            # The row stays locked until commit, so this is our own increment
+            return cls.objects.filter(pk=1).values_list("version", flat=True).get()
+
+
+class CurrencyCache:
+    """Per-process cache of currencies, keyed by ticker symbol.
+
+    The local copy is dropped on `Currency` post_save/post_delete (see
+    `core.signals`). Other processes notice the change through `PriceVersion`,
+    which is re-read at most once every `CURRENCY_CACHE_TTL` seconds, so a price
+    edit reaches every worker within that delay.
+    Changes made with `QuerySet.update()` send no signals, call
+    `PriceVersion.bump()` after those.
+    Cached instances are shared, treat them as read-only.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._by_symbol = {}
+        self._by_pk = {}
+        self._version = None
+        self._checked_at = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._by_symbol = {}
+            self._by_pk = {}
+            self._checked_at = None
+
+    def get(self, symbol: str) -> Currency:
+        """Returns the currency, raises `Currency.DoesNotExist` if there is none."""
+        currency = self.get_many([symbol]).get(symbol)
+        if currency is None:
+            raise Currency.DoesNotExist(f"Currency {symbol} does not exist.")
+        return currency
+
+    def get_by_pk(self, pk: int) -> Currency:
+        self._validate()
+        currency = self._by_pk.get(pk)
+        if currency is None:
+            currency = Currency.objects.get(pk=pk)
+            self._add([currency])
+        return currency
+
+    def get_many(self, symbols) -> dict:
+        """Returns the existing currencies among `symbols`, keyed by ticker symbol."""
+        self._validate()
+        by_symbol = self._by_symbol
+        missing = [symbol for symbol in symbols if symbol not in by_symbol]
+        if missing:
+            self._add(Currency.objects.filter(ticker_symbol__in=missing))
+            by_symbol = self._by_symbol
+        return {symbol: by_symbol[symbol] for symbol in symbols if symbol in by_symbol}
+
+    def _add(self, currencies) -> None:
+        with self._lock:
+            for currency in currencies:
+                self._by_symbol[currency.ticker_symbol] = currency
+                self._by_pk[currency.pk] = currency
+
+    async def aget_many(self, symbols) -> dict:
+        """Same as `get_many`, only leaves the event loop if the database is needed."""
+        by_symbol = self._by_symbol
+        if self._is_fresh() and all(symbol in by_symbol for symbol in symbols):
+            return {symbol: by_symbol[symbol] for symbol in symbols}
+        return await sync_to_async(self.get_many)(symbols)
+
+    def _is_fresh(self) -> bool:
+        checked_at = self._checked_at
+        return (
+            checked_at is not None
+            and time.monotonic() - checked_at < settings.CURRENCY_CACHE_TTL
+        )
+
+    def _validate(self) -> None:
+        if self._is_fresh():
+            return
+        now = time.monotonic()
+        version = PriceVersion.current()
+        if version != self._version:
+            self.clear()
+        self._version = version
+        self._checked_at = now
+
+
+currency_cache = CurrencyCache()
+
 
 class Balance(models.Model):
     currency = models.ForeignKey(to=Currency, on_delete=models.PROTECT)
-    amount = models.DecimalField(
-        "Currency Amount", default=0, decimal_places=4, max_digits=12
-    )
+    amount = MicroAmountField("Currency Amount", default=0)
 
     class Meta:
         abstract = True
 
     @property
     def in_dollars(self):
-        return self.currency.dollar_value * self.amount
+        return currency_cache.get_by_pk(self.currency_id).dollar_value * self.amount
+
+    @classmethod
+    def holdings(cls, *fields, **lookup):
+        """Amount held of each currency, summed in SQL, with the currency's price.
+
+        One query joining `Currency`, grouped by currency and by `fields`, eg.
+        `UserBalance.holdings("user")` returns every user's holdings at once.
+        Rows are dicts with `fields`, `symbol`, `dollar_value` and `total`.
+        """
+        return (
+            cls.objects.filter(**lookup)
+            .values(
+                *fields,
+                symbol=F("currency__ticker_symbol"),
+                dollar_value=F("currency__dollar_value"),
+            )
+            .annotate(total=Sum("amount"))
+            .exclude(total=0)
+            .order_by(*fields, "symbol")
+        )
 
     def increase_amount(self, amount):
-        self.amount += amount
-        self.save()
+        """Adds `amount` in a single UPDATE, so concurrent writers don't lose updates."""
+        type(self).objects.filter(pk=self.pk).update(
+            amount=F("amount") + to_units(amount)
+        )
+        self.refresh_from_db(fields=["amount"])
 
     def decrease_amount(self, amount):
-        self.amount -= amount
-        self.save()
+        """Subtracts `amount` in a single UPDATE, so concurrent writers don't lose updates."""
+        type(self).objects.filter(pk=self.pk).update(
+            amount=F("amount") - to_units(amount)
+        )
+        self.refresh_from_db(fields=["amount"])
+
+    @classmethod
+    def normalize_amount(cls, amount) -> Decimal:
+        """Rounds `amount` to the precision `amount` is stored with."""
+        return quantize(amount)
+
+    @classmethod
+    def apply_delta(cls, amount, minimum=None, **lookup) -> bool:
+        """Adds `amount` (may be negative) to the balance matching `lookup`.
+
+        The change is applied as `UPDATE ... SET amount = amount + x WHERE ...`.
+        When `minimum` is given, the row is only updated if its current amount
+        is at least `minimum`; returns False if no row qualified.
+        A missing balance is created on the fly unless a guard is requested.
+        """
+        amount = cls.normalize_amount(amount)
+        units = to_units(amount)
+        balances = cls.objects.filter(**lookup)
+        if minimum is not None:
+            minimum = cls.normalize_amount(minimum)
+            return bool(
+                balances.filter(amount__gte=minimum).update(amount=F("amount") + units)
+            )
+        if balances.update(amount=F("amount") + units):
+            return True
+        _, created = cls.objects.get_or_create(**lookup, defaults={"amount": amount})
+        if not created:
+            # Lost the race against a concurrent insert, the row exists now.
+            balances.update(amount=F("amount") + units)
+        return True
 
     def update_amount(self, amount):
         self.amount = amount
@@ -53,29 +240,570 @@ class UserBalance(Balance):
 
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "currency"], name="unique_user_balance"
+            )
+        ]
+
     def __str__(self) -> str:
         return f"{self.user.username} | {self.currency.ticker_symbol} | ({self.amount})"
 
+    def adjust(self, previous: Decimal) -> None:
+        """Saves an amount set by hand, recording the change from `previous` in
+        the ledger. Call inside a transaction that has the row locked."""
+        self.save()
+        change = self.normalize_amount(self.amount) - previous
+        if change:
+            LedgerEntry.objects.create(
+                user_id=self.user_id, currency_id=self.currency_id, amount=change
+            )
+
 
 class TreasuryBalance(Balance):
-    """How much of each currency do we have in the treasury."""
+    """How much of each currency do we have in the treasury.
+
+    Buys and exchange fills don't update these rows, they only append
+    `LedgerEntry`s, so they never wait on a treasury row lock.
+    `LedgerSnapshot.compact` folds those entries into the rows later. The
+    holding of a currency is its row plus the treasury entries written since
+    the last compaction, see `holding`.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["currency"], name="unique_treasury_balance")
+        ]
 
     def __str__(self) -> str:
         return f"{self.currency.ticker_symbol} | {self.amount}"
 
+    def adjust(self, previous: Decimal) -> None:
+        """Applies an amount set by hand through the ledger, like any treasury
+        write: the row keeps `previous` and the change is appended as an entry.
+        Call inside a transaction that has the row locked."""
+        change = self.normalize_amount(self.amount) - previous
+        self.amount = previous
+        self.save()
+        if change:
+            LedgerEntry.objects.create(currency_id=self.currency_id, amount=change)
+
+    @classmethod
+    def holding(cls, currency=OuterRef("pk")):
+        """The treasury holding of `currency`, as an expression.
+
+        The row and recent entries are read in the same query, so a compaction
+        committing in between can't be counted twice or missed.
+        """
+        row = cls.objects.filter(currency=currency).values("amount")
+        entries = (
+            LedgerEntry.objects.filter(
+                user=None, currency=currency, id__gt=LedgerSnapshot.watermark()
+            )
+            .values("currency")
+            .annotate(total=Sum("amount"))
+            .values("total")
+        )
+        return ExpressionWrapper(
+            Coalesce(Subquery(row), 0) + Coalesce(Subquery(entries), 0),
+            output_field=MicroAmountField(),
+        )
+
+    @classmethod
+    def total(cls, currency: Currency) -> Decimal:
+        """Treasury holding of `currency`, see `holding`."""
+        return (
+            Currency.objects.filter(pk=currency.pk)
+            .annotate(total=cls.holding())
+            .values_list("total", flat=True)
+            .first()
+        ) or Decimal(0)
+
+    @classmethod
+    def totals(cls):
+        """`{"currency": id, "total": amount}` per currency, as a queryset."""
+        return Currency.objects.annotate(total=cls.holding()).values(
+            "total", currency=F("pk")
+        )
+
+    @classmethod
+    def holdings(cls):
+        """Treasury holdings, in the rows of `Balance.holdings`."""
+        return (
+            Currency.objects.annotate(total=cls.holding())
+            .values("dollar_value", "total", symbol=F("ticker_symbol"))
+            .exclude(total=0)
+            .order_by("symbol")
+        )
+
+
+class LedgerEntry(models.Model):
+    """Append-only record of a single balance change.
+
+    Entries are never updated or deleted. An empty `user` is the treasury.
+    """
+
+    user = models.ForeignKey(to=User, on_delete=models.PROTECT, null=True, blank=True)
+    currency = models.ForeignKey(to=Currency, on_delete=models.PROTECT)
+    amount = MicroAmountField("Change")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = "ledger entries"
+        indexes = [
+            models.Index(fields=["user", "currency", "id"], name="ledger_account_idx")
+        ]
+
+    def __str__(self) -> str:
+        account = self.user.username if self.user_id else "treasury"
+        return f"{account} | {self.currency.ticker_symbol} | {self.amount:+}"
+
+    @classmethod
+    def balance_of(cls, currency: Currency, user: User = None) -> Decimal:
+        """Latest snapshot of the account plus every entry written after it."""
+        snapshot = (
+            LedgerSnapshot.objects.filter(user=user, currency=currency)
+            .values_list("amount", "last_entry_id")
+            .first()
+        )
+        amount, last_entry_id = snapshot or (Decimal(0), 0)
+        delta = cls.objects.filter(
+            user=user, currency=currency, id__gt=last_entry_id
+        ).aggregate(total=Sum("amount"))["total"]
+        return amount + (delta or 0)
+
+
+class TreasuryDemand(models.Model):
+    """How fast users buy a currency from the treasury, see `observe`."""
+
+    currency = models.OneToOneField(
+        to=Currency, on_delete=models.CASCADE, primary_key=True
+    )
+    # Exponentially weighted, in units per second
+    rate = models.FloatField(default=0)
+    # Sales are counted up to this ledger entry...
+    last_entry_id = models.BigIntegerField(default=0)
+    # ...which was the last one at this time
+    observed_at = models.DateTimeField()
+
+    def __str__(self) -> str:
+        return f"{self.currency.ticker_symbol} | {self.rate:g}/s"
+
+    @classmethod
+    def observe(cls, half_life: float = None) -> dict:
+        """Folds the treasury's sales since the last call into each currency's
+        buy rate, returns the rates by currency id.
+
+        The weight of past sales halves every `half_life` seconds. Sales are
+        read from the ledger, as the treasury's negative entries.
+        """
+        if half_life is None:
+            half_life = settings.TREASURY_DEMAND_HALF_LIFE
+        now = timezone.now()
+        with transaction.atomic():
+            demands = {
+                demand.currency_id: demand for demand in cls.objects.select_for_update()
+            }
+            if not demands:
+                # Start counting from here
+                last_entry_id = LedgerEntry.objects.aggregate(last=Max("id"))["last"]
+                cls.objects.bulk_create(
+                    [
+                        cls(
+                            currency_id=pk,
+                            last_entry_id=last_entry_id or 0,
+                            observed_at=now,
+                        )
+                        for pk in Currency.objects.values_list("pk", flat=True)
+                    ],
+                    # Another process may be starting too
+                    ignore_conflicts=True,
+                )
+                return {}
+
+            last_entry_id = max(demand.last_entry_id for demand in demands.values())
+            observed_at = max(demand.observed_at for demand in demands.values())
+            elapsed = (now - observed_at).total_seconds()
+            if elapsed <= 0:
+                return {pk: demand.rate for pk, demand in demands.items()}
+
+            sold = {
+                row["currency"]: row
+                for row in LedgerEntry.objects.filter(
+                    id__gt=last_entry_id, user__isnull=True, amount__lt=0
+                )
+                .values("currency")
+                .annotate(total=Sum("amount"), last=Max("id"))
+            }
+            last_entry_id = max(
+                [last_entry_id] + [row["last"] for row in sold.values()]
+            )
+            weight = 0.5 ** (elapsed / half_life)
+            new = sold.keys() - demands.keys()
+            for currency_id in new:
+                demands[currency_id] = cls(currency_id=currency_id)
+            for currency_id, demand in demands.items():
+                volume = -sold[currency_id]["total"] if currency_id in sold else 0
+                rate = float(volume) / elapsed
+                demand.rate = weight * demand.rate + (1 - weight) * rate
+                demand.last_entry_id = last_entry_id
+                demand.observed_at = now
+            cls.objects.bulk_create([demands[pk] for pk in new], ignore_conflicts=True)
+            cls.objects.bulk_update(
+                [demand for pk, demand in demands.items() if pk not in new],
+                ["rate", "last_entry_id", "observed_at"],
+            )
+        return {pk: demand.rate for pk, demand in demands.items()}
+
+
+class LedgerWatermark(models.Model):
+    """Id of the last ledger entry compacted, a single row.
+
+    Every entry up to it is in the snapshots and in `TreasuryBalance`, see
+    `LedgerSnapshot.compact`.
+    """
+
+    last_entry_id = models.BigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"#{self.last_entry_id}"
+
+
+class LedgerSnapshot(models.Model):
+    """Balance of an account, as of ledger entry `last_entry_id`.
+
+    Compaction also folds the treasury's entries into `TreasuryBalance`.
+    Only the snapshots of accounts with new entries are rolled forward, the
+    others keep the `last_entry_id` of their own last change.
+    """
+
+    user = models.ForeignKey(to=User, on_delete=models.PROTECT, null=True, blank=True)
+    currency = models.ForeignKey(to=Currency, on_delete=models.PROTECT)
+    amount = MicroAmountField("Currency Amount", default=0)
+    last_entry_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "currency"],
+                condition=models.Q(user__isnull=False),
+                name="unique_user_snapshot",
+            ),
+            models.UniqueConstraint(
+                fields=["currency"],
+                condition=models.Q(user__isnull=True),
+                name="unique_treasury_snapshot",
+            ),
+        ]
+
+    @classmethod
+    def watermark(cls):
+        """Id of the last entry compacted, as an expression."""
+        return Coalesce(
+            Subquery(LedgerWatermark.objects.filter(pk=1).values("last_entry_id")),
+            0,
+        )
+
+    @classmethod
+    def compact(cls, older_than: float = None, batch_size: int = 500) -> int:
+        """Rolls the snapshots forward, returns the id of the last entry included.
+
+        Only entries older than `older_than` seconds are included, so that
+        transactions still inserting lower ids have committed by then.
+        Snapshots are read and written `batch_size` accounts at a time.
+        """
+        if older_than is None:
+            older_than = settings.LEDGER_COMPACTION_DELAY
+        cutoff = timezone.now() - timedelta(seconds=older_than)
+
+        with transaction.atomic():
+            watermark, _ = LedgerWatermark.objects.select_for_update().get_or_create(
+                pk=1
+            )
+            previous = watermark.last_entry_id
+            upto = LedgerEntry.objects.filter(
+                id__gt=previous, created_at__lte=cutoff
+            ).aggregate(last=Max("id"))["last"]
+            if upto is None:
+                return previous
+
+            deltas = list(
+                LedgerEntry.objects.filter(id__gt=previous, id__lte=upto)
+                .values_list("user_id", "currency_id")
+                .annotate(total=Sum("amount"))
+                .order_by()
+            )
+            for start in range(0, len(deltas), batch_size):
+                cls._roll_forward(deltas[start : start + batch_size], upto)
+
+            watermark.last_entry_id = upto
+            watermark.save(update_fields=["last_entry_id"])
+        return upto
+
+    @classmethod
+    def _roll_forward(cls, deltas: list, upto: int) -> None:
+        """Adds `(user_id, currency_id, total)` deltas to their snapshots."""
+        users = {user_id for user_id, _, _ in deltas if user_id is not None}
+        treasury = {
+            currency_id for user_id, currency_id, _ in deltas if user_id is None
+        }
+        snapshots = {
+            (snapshot.user_id, snapshot.currency_id): snapshot
+            for snapshot in cls.objects.select_for_update().filter(
+                Q(user__in=users) | Q(user=None, currency__in=treasury)
+            )
+        }
+        updated, created = [], []
+        for user_id, currency_id, total in deltas:
+            if user_id is None:
+                TreasuryBalance.apply_delta(total, currency_id=currency_id)
+            snapshot = snapshots.get((user_id, currency_id))
+            if snapshot is None:
+                created.append(
+                    cls(
+                        user_id=user_id,
+                        currency_id=currency_id,
+                        amount=total,
+                        last_entry_id=upto,
+                    )
+                )
+            else:
+                snapshot.amount += total
+                snapshot.last_entry_id = upto
+                updated.append(snapshot)
+        cls.objects.bulk_update(updated, ["amount", "last_entry_id"])
+        cls.objects.bulk_create(created)
+
+
+class Order(models.Model):
+    """A purchase accepted for later, filled in batches by `process_orders`."""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        FILLED = "filled", "Filled"
+        REJECTED = "rejected", "Rejected"
+
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE)
+    currency = models.ForeignKey(to=Currency, on_delete=models.PROTECT)
+    amount = MicroAmountField("Currency Amount")
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.PENDING
+    )
+    error = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="order_status_idx"),
+            models.Index(fields=["user", "id"], name="order_user_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"#{self.pk} | {self.user.username} | {self.currency.ticker_symbol} | {self.status}"
+
+
+class ExchangeCommand(models.Model):
+    """Outbox of treasury purchases, see `OutboxDispatcher`.
+
+    A buy adds a command for the currency it took from the treasury, in the
+    buy's own transaction, so the purchase can't be lost once the buy is
+    committed. There is at most one pending command per currency: later buys
+    are folded into it. `order_id` is sent to the exchange as the client order
+    id, so a command that is dispatched twice is only filled once.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        CLAIMED = "claimed", "Claimed"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    currency = models.ForeignKey(to=Currency, on_delete=models.PROTECT)
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.PENDING
+    )
+    order_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["currency"],
+                condition=models.Q(status="pending"),
+                name="unique_pending_command",
+            )
+        ]
+        indexes = [models.Index(fields=["status", "id"], name="command_status_idx")]
+
+    def __str__(self) -> str:
+        return f"#{self.pk} | {self.currency.ticker_symbol} | {self.status}"
+
+    @classmethod
+    def enqueue(cls, currencies) -> None:
+        """Asks for the treasury's `currencies` to be replenished, with one INSERT.
+
+        Call inside the transaction that took them from the treasury.
+        """
+        cls.objects.bulk_create(
+            [cls(currency=currency) for currency in currencies],
+            ignore_conflicts=True,
+        )
+
+
+class IdempotencyKey(models.Model):
+    """The response to a request made with an `Idempotency-Key` header.
+
+    A retry with the same key gets the stored response back instead of being
+    handled again. Keys are per user and expire after `IDEMPOTENCY_KEY_TTL`
+    seconds, `sweep_idempotency_keys` deletes expired ones.
+    """
+
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # Hash of the request body, a key can't be reused for a different request
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_idempotency_key"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.user.username} | {self.key} | {self.status_code}"
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expires_at <= timezone.now()
+
+    @classmethod
+    def lookup(cls, user: User, key: str):
+        """Returns the live stored response for `key`, or None."""
+        stored = idempotency_cache.get((user.pk, key))
+        if stored is None:
+            stored = cls.objects.filter(user=user, key=key).first()
+            if stored is None:
+                return None
+        if stored.is_expired:
+            idempotency_cache.discard((user.pk, key))
+            cls.objects.filter(pk=stored.pk).delete()
+            return None
+        idempotency_cache.add((user.pk, key), stored)
+        return stored
+
+    @classmethod
+    def store(cls, user: User, key: str, fingerprint: str, status_code: int, response):
+        """Saves a response, raises `IntegrityError` if `key` was stored meanwhile.
+
+        Called inside the transaction of the request, so the response is only
+        kept if the request's changes are.
+        """
+        stored = cls.objects.create(
+            user=user,
+            key=key,
+            fingerprint=fingerprint,
+            status_code=status_code,
+            response=response,
+            expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+        )
+        transaction.on_commit(lambda: idempotency_cache.add((user.pk, key), stored))
+        return stored
+
+    @classmethod
+    def sweep(cls) -> int:
+        """Deletes expired keys, returns how many."""
+        deleted, _ = cls.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+
+class LRUCache:
+    """A small thread safe, least recently used cache."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def add(self, key, value) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, key) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+idempotency_cache = LRUCache(settings.IDEMPOTENCY_CACHE_SIZE)
+
 
 class Exchange(models.Model):
     "Foreign exchange we can call to exchange currencies."
+
+    class Adapter(models.TextChoices):
+        SIMULATED = "simulated", "Simulated"
+        HTTP = "http", "HTTP API"
+
     title = models.CharField("Exchange Name", max_length=50)
+    adapter = models.CharField(
+        max_length=20, choices=Adapter.choices, default=Adapter.SIMULATED
+    )
+    url = models.URLField("API URL", blank=True)
 
     def __str__(self) -> str:
         return self.title
 
+    def clean(self):
+        if self.adapter == self.Adapter.HTTP and not self.url:
+            raise ValidationError({"url": "The HTTP adapter needs the API URL."})
+
+    @property
+    def client(self):
+        """Places orders on this exchange, see `core.exchanges`."""
+        return get_client(self)
+
     def buy_from_exchange(self, amount: Decimal, symbol: str) -> bool:
-        """Adds the requested amount of currency to the treasury."""
+        """Buys the requested amount of currency and adds it to the treasury.
+
+        The exchange is called outside of any transaction, so no rows are
+        locked while waiting for it; raises `ExchangeError` if it fails.
+        """
+        currency, filled = self.place_order(amount, symbol)
+        with transaction.atomic():
+            self.credit_treasury(currency, filled)
+        return True
+
+    def place_order(
+        self, amount: Decimal, symbol: str, client_order_id: str = None
+    ) -> tuple:
+        """Buys `amount` of `symbol`, returns the currency and the filled amount."""
 
         # Throws an error if currency does not exist
-        currency = Currency.objects.get(ticker_symbol=symbol)
+        currency = currency_cache.get(symbol)
 
         if Decimal(currency.dollar_value * amount) < Decimal(
             settings.MINIMUM_ORDER_USD_VALUE
@@ -83,12 +811,8 @@ class Exchange(models.Model):
             raise ValueError(
                 f"Dollar amount should be at least {settings.MINIMUM_ORDER_USD_VALUE}"
             )
-        else:
-            treasury_balance, created = TreasuryBalance.objects.get_or_create(
-                currency=currency
-            )
-            if created:
-                treasury_balance.update_amount(amount)
-            else:
-                treasury_balance.increase_amount(amount)
-            treasury_balance.save()
+        return currency, self.client.buy(symbol, amount, client_order_id)
+
+    def credit_treasury(self, currency: Currency, amount: Decimal) -> None:
+        """Adds a fill to the treasury, call inside a transaction."""
+        LedgerEntry.objects.create(currency=currency, amount=amount)
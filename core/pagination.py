@@ -0,0 +1,128 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param
+
+Cursor = namedtuple("Cursor", ["reverse", "position"])
+
+
+class CursorPagination(pagination.CursorPagination):
+    """Keyset pagination, ordered by the view's `ordering`.
+
+    Unlike DRF's cursor, which only remembers the first ordering field and
+    falls back to OFFSET for rows sharing its value, the cursor holds the
+    values of every ordering field. Pages are fetched with
+    `WHERE (a, b) < (x, y) ORDER BY a, b LIMIT n`, so the last page costs as
+    much as the first, given an index matching the ordering.
+    Ordering fields must be concrete, non relational fields.
+    """
+
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        ordering = self.ordering
+        if reverse:
+            ordering = tuple(_invert(field) for field in ordering)
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None:
+            position = self._clean_position(queryset.model, self.cursor.position)
+            queryset = queryset.filter(_after(ordering, position))
+
+        # One more row than needed tells whether there is another page
+        results = list(queryset[: self.page_size + 1])
+        self.page = results[: self.page_size]
+        has_more = len(results) > self.page_size
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, "ordering", self.ordering)
+        if isinstance(ordering, str):
+            return (ordering,)
+        return tuple(ordering)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(False, self._position(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(True, self._position(self.page[0])))
+
+    def encode_cursor(self, cursor):
+        # str() keeps the microseconds of datetimes, unlike DjangoJSONEncoder
+        data = json.dumps([int(cursor.reverse), cursor.position], default=str)
+        encoded = base64.urlsafe_b64encode(data.encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            reverse, position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if len(position) != len(self.ordering):
+                raise ValueError("Cursor does not match the ordering.")
+        except (TypeError, ValueError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(bool(reverse), position)
+
+    def _position(self, instance) -> list:
+        return [getattr(instance, field.lstrip("-")) for field in self.ordering]
+
+    def _clean_position(self, model, position) -> list:
+        try:
+            return [
+                model._meta.get_field(field.lstrip("-")).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+        except ValidationError:
+            raise NotFound(self.invalid_cursor_message)
+
+
+def _invert(field: str) -> str:
+    return field[1:] if field.startswith("-") else f"-{field}"
+
+
+def _after(ordering, position) -> Q:
+    """Rows that come after `position` in `ordering`.
+
+    `(a, b) > (x, y)` is spelled `a >= x AND (a > x OR (a = x AND b > y))`,
+    the leading range lets the database seek the index on `a` first.
+    """
+    lookups = [
+        (field.lstrip("-"), "lt" if field.startswith("-") else "gt")
+        for field in ordering
+    ]
+    after = Q()
+    for index, (name, lookup) in enumerate(lookups):
+        ties = {tied: value for (tied, _), value in zip(lookups[:index], position)}
+        after |= Q(**ties, **{f"{name}__{lookup}": position[index]})
+    name, lookup = lookups[0]
+    return Q(**{f"{name}__{lookup}e": position[0]}) & after
@@ -0,0 +1,165 @@
+"""Signed price quotes.
+
+A quote fixes the price of a purchase for `QUOTE_TTL` seconds. It is handed
+to the client as a token signed with `SECRET_KEY`, so it needs no storage and
+is checked without a query; the client can't alter it, and it can only be
+used by the user it was issued to. Each quote carries a nonce, filling it
+stores that nonce so the quote is filled at most once.
+"""
+
+import secrets
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+
+from core.fixedpoint import quantize
+from core.models import Currency, IdempotencyKey, currency_cache
+
+SALT = "core.quotes"
+
+
+class InvalidQuote(ValueError):
+    """Raised for tampered, expired or foreign quote tokens."""
+
+
+class Quote:
+    """The price of `amount` of a currency, for one user.
+
+    A quote loaded from a token doesn't look anything up: its `currency` and
+    `base_currency` only carry their id and ticker symbol.
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        currency: Currency,
+        base_currency: Currency,
+        amount: Decimal,
+        rate: Decimal,
+        total: Decimal,
+        price_version: int,
+        issued_at=None,
+        nonce: str = None,
+    ) -> None:
+        self.user_id = user_id
+        self.currency = currency
+        self.base_currency = base_currency
+        self.amount = amount
+        # Price of one unit, in the base currency
+        self.rate = rate
+        # What `amount` costs, in the base currency
+        self.total = total
+        self.price_version = price_version
+        self.issued_at = issued_at or timezone.now()
+        self.nonce = nonce or secrets.token_urlsafe(12)
+
+    @property
+    def symbol(self) -> str:
+        return self.currency.ticker_symbol
+
+    @property
+    def expires_at(self):
+        return self.issued_at + timedelta(seconds=settings.QUOTE_TTL)
+
+    @classmethod
+    def issue(cls, user, symbol: str, amount: Decimal) -> "Quote":
+        """Prices `amount` of `symbol`, raises `Currency.DoesNotExist`."""
+        currencies = currency_cache.get_many([symbol, settings.BASE_CURRENCY_SYMBOL])
+        currency = currencies.get(symbol)
+        base_currency = currencies.get(settings.BASE_CURRENCY_SYMBOL)
+        if currency is None or base_currency is None:
+            raise Currency.DoesNotExist(f"Currency {symbol} does not exist.")
+        amount = quantize(amount)
+        return cls(
+            user_id=user.pk,
+            currency=currency,
+            base_currency=base_currency,
+            amount=amount,
+            rate=quantize(currency.dollar_value / base_currency.dollar_value),
+            total=quantize(
+                Decimal(currency.dollar_value) * amount / base_currency.dollar_value
+            ),
+            price_version=max(currency.price_version, base_currency.price_version),
+        )
+
+    def sign(self) -> str:
+        return signing.dumps(
+            [
+                self.user_id,
+                self.currency.pk,
+                self.currency.ticker_symbol,
+                self.base_currency.pk,
+                str(self.amount),
+                str(self.rate),
+                str(self.total),
+                self.price_version,
+                self.issued_at.timestamp(),
+                self.nonce,
+            ],
+            salt=SALT,
+        )
+
+    @classmethod
+    def load(cls, token: str, user) -> "Quote":
+        """Checks and decodes a token made by `sign`."""
+        try:
+            data = signing.loads(token, salt=SALT, max_age=settings.QUOTE_TTL)
+        except signing.SignatureExpired:
+            raise InvalidQuote("Quote has expired.")
+        except signing.BadSignature:
+            raise InvalidQuote("Invalid quote.")
+
+        (
+            user_id,
+            currency_id,
+            symbol,
+            base_currency_id,
+            amount,
+            rate,
+            total,
+            price_version,
+            issued_at,
+            nonce,
+        ) = data
+        if user_id != user.pk:
+            raise InvalidQuote("Invalid quote.")
+        return cls(
+            user_id=user_id,
+            currency=Currency(pk=currency_id, ticker_symbol=symbol),
+            base_currency=Currency(
+                pk=base_currency_id, ticker_symbol=settings.BASE_CURRENCY_SYMBOL
+            ),
+            amount=Decimal(amount),
+            rate=Decimal(rate),
+            total=Decimal(total),
+            price_version=price_version,
+            issued_at=datetime.fromtimestamp(issued_at, tz=dt_timezone.utc),
+            nonce=nonce,
+        )
+
+    def consume(self) -> None:
+        """Marks the quote filled, raises `InvalidQuote` if it was already.
+
+        Called in the transaction of the fill, so a failed fill leaves the
+        quote usable. The nonce is kept as an idempotency key of the user, no
+        request can match its empty fingerprint, and is swept with them.
+        """
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(
+                    user_id=self.user_id,
+                    key=f"quote:{self.nonce}",
+                    fingerprint="",
+                    status_code=status.HTTP_409_CONFLICT,
+                    response={"error": "Quote was already used."},
+                    expires_at=timezone.now()
+                    + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+                )
+        except IntegrityError:
+            raise InvalidQuote("Quote was already used.")
@@ -0,0 +1,64 @@
+import csv
+import io
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+
+class StreamingRenderer(BaseRenderer):
+    """Renders rows one batch at a time, see `stream`.
+
+    `render` handles regular responses (eg. errors) as a list of dicts, or a
+    single one.
+    """
+
+    charset = "utf-8"
+    # Rows per chunk of the response, a chunk per row makes for tiny writes
+    batch_size = 1000
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data if isinstance(data, list) else [data]
+        fields = list(rows[0]) if rows else []
+        return "".join(
+            self.stream(fields, ([row.get(field) for field in fields] for row in rows))
+        )
+
+    def stream(self, fields: list, rows):
+        """Yields the document, `rows` being sequences of values of `fields`."""
+        rows = iter(rows)
+        yield self.header(fields)
+        while batch := list(islice(rows, self.batch_size)):
+            yield self.lines(fields, batch)
+
+    def header(self, fields: list) -> str:
+        return ""
+
+    def lines(self, fields: list, rows: list) -> str:
+        raise NotImplementedError
+
+
+class JSONLinesRenderer(StreamingRenderer):
+    """A JSON object per line."""
+
+    media_type = "application/jsonl"
+    format = "jsonl"
+
+    def lines(self, fields: list, rows: list) -> str:
+        encoder = DjangoJSONEncoder()
+        return "".join(encoder.encode(dict(zip(fields, row))) + "\n" for row in rows)
+
+
+class CSVRenderer(StreamingRenderer):
+    """CSV with a header row, the counterpart of `CSVParser`."""
+
+    media_type = "text/csv"
+    format = "csv"
+
+    def header(self, fields: list) -> str:
+        return self.lines(fields, [fields])
+
+    def lines(self, fields: list, rows: list) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
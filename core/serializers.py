@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from core.models import Currency
+from core.fixedpoint import QUANTUM, MicroAmountField
+from core.models import Currency, Order
+
 User = get_user_model()
 
 
@@ -9,11 +11,126 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
         model = User
         fields = ["url", "username", "email", "groups"]
 
+
 class CurrencySerializer(serializers.HyperlinkedModelSerializer):
+    dollar_value = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+    )
+    treasury_threshold = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+        required=False,
+        allow_null=True,
+    )
+
     class Meta:
         model = Currency
-        fields = ["url", "display_name", "ticker_symbol", "dollar_value"]
+        fields = [
+            "url",
+            "display_name",
+            "ticker_symbol",
+            "dollar_value",
+            "treasury_threshold",
+            "price_version",
+        ]
+        read_only_fields = ["price_version"]
+
+
+class PriceSerializer(serializers.Serializer):
+    """One line of a price sheet."""
+
+    ticker_symbol = serializers.CharField(max_length=6)
+    dollar_value = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+        min_value=QUANTUM,
+    )
+
 
 class CurrencyExchangeSerializer(serializers.Serializer):
     symbol = serializers.CharField(max_length=8)
-    amount = serializers.DecimalField(decimal_places=4, max_digits=12)
+    amount = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+        min_value=QUANTUM,
+    )
+    # Currency to pay in, defaults to the base currency
+    pay_with = serializers.CharField(max_length=8, required=False)
+
+    def validate(self, data):
+        if data.get("pay_with") == data["symbol"]:
+            raise serializers.ValidationError(
+                {"pay_with": "Can't pay with the currency being bought."}
+            )
+        return data
+
+
+class QuotedBuySerializer(serializers.Serializer):
+    quote = serializers.CharField()
+
+
+class QuoteSerializer(serializers.Serializer):
+    quote = serializers.CharField(source="sign")
+    symbol = serializers.CharField()
+    amount = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+    )
+    base_currency = serializers.CharField(source="base_currency.ticker_symbol")
+    rate = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+    )
+    total = serializers.DecimalField(
+        max_digits=None, decimal_places=MicroAmountField.decimal_places
+    )
+    price_version = serializers.IntegerField()
+    expires_at = serializers.DateTimeField()
+
+
+class OrderSerializer(serializers.HyperlinkedModelSerializer):
+    symbol = serializers.SlugRelatedField(
+        source="currency", slug_field="ticker_symbol", read_only=True
+    )
+    amount = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+        read_only=True,
+    )
+
+    class Meta:
+        model = Order
+        fields = [
+            "url",
+            "id",
+            "symbol",
+            "amount",
+            "status",
+            "error",
+            "created_at",
+            "processed_at",
+        ]
+
+
+class HoldingSerializer(serializers.Serializer):
+    symbol = serializers.CharField()
+    amount = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+    )
+    dollar_value = serializers.DecimalField(
+        max_digits=MicroAmountField.max_digits,
+        decimal_places=MicroAmountField.decimal_places,
+    )
+    # A product of two amounts, may have more digits than either
+    usd_value = serializers.DecimalField(
+        max_digits=None, decimal_places=MicroAmountField.decimal_places
+    )
+
+
+class PortfolioSerializer(serializers.Serializer):
+    holdings = HoldingSerializer(many=True)
+    total_usd = serializers.DecimalField(
+        max_digits=None, decimal_places=MicroAmountField.decimal_places
+    )
@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core.middleware import record_query
+from core.models import (
+    Currency,
+    LedgerEntry,
+    PriceVersion,
+    TreasuryBalance,
+    UserBalance,
+    currency_cache,
+)
+
+
+@receiver(post_save, sender=Currency)
+def stamp_price_version(sender, instance, **kwargs):
+    """Starts a new price generation, and tells the other workers about it.
+
+    Bumped after the row is written, in the save's transaction if there is
+    one, so no worker sees the new version before the new price.
+    """
+    with transaction.atomic():
+        instance.price_version = PriceVersion.bump()
+        Currency.objects.filter(pk=instance.pk).update(
+            price_version=instance.price_version
+        )
+
+
+@receiver(post_save, sender=Currency)
+def clear_currency_cache(sender, **kwargs):
+    currency_cache.clear()
+
+
+@receiver(post_delete, sender=Currency)
+def invalidate_currency_cache(sender, **kwargs):
+    """Drops cached prices here, and tells the other workers to do the same."""
+    currency_cache.clear()
+    PriceVersion.bump()
+
+
+@receiver(post_save, sender=UserBalance)
+def record_loaded_user_balance(sender, instance, raw, **kwargs):
+    """Opens the ledger of balances loaded from fixtures, eg. by `loaddata`."""
+    if raw:
+        instance.adjust(LedgerEntry.balance_of(instance.currency_id, instance.user_id))
+
+
+@receiver(post_save, sender=TreasuryBalance)
+def record_loaded_treasury_balance(sender, instance, raw, **kwargs):
+    """Same for the treasury, whose loaded amount is moved into the ledger."""
+    if not raw:
+        return
+    change = instance.amount - LedgerEntry.balance_of(instance.currency_id)
+    if change:
+        LedgerEntry.objects.create(currency_id=instance.currency_id, amount=change)
+    # The holding is the row plus the entries since the last compaction
+    holding = TreasuryBalance.total(Currency(pk=instance.currency_id))
+    TreasuryBalance.apply_delta(instance.amount - holding, pk=instance.pk)
+
+
+@receiver(connection_created)
+def measure_queries(sender, connection, **kwargs):
+    """Lets `MetricsMiddleware` count queries on whichever thread runs them."""
+    connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    """Lets SQLite readers and writers work side by side, see `SQLITE_*` settings."""
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"PRAGMA journal_mode = {settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous = {settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(
+            f"PRAGMA busy_timeout = {int(settings.SQLITE_BUSY_TIMEOUT * 1000)}"
+        )
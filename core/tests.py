@@ -1,13 +1,89 @@
+import base64
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
+from asgiref.sync import async_to_sync, iscoroutinefunction
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F, Sum
+from django.http import HttpResponse
+from django.test import (
+    AsyncClient,
+    Client,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
 
-from core.utils import PurchaceHandler
+from core import metrics, tokens
+from core.exchanges import (
+    CircuitBreaker,
+    ExchangeError,
+    ExchangeUnavailable,
+    HTTPExchange,
+)
+from core.fixedpoint import from_units, quantize, to_units
+from core.management.commands.benchmark import Benchmark, percentile
+from core.management.commands.seed import Seeder
+from core.metrics import HISTOGRAMS, Histogram
+from core.middleware import MetricsMiddleware
+from core.mock_exchange import MockExchangeServer
+from core.quotes import InvalidQuote, Quote
+from core.utils import (
+    AsyncPurchaceHandler,
+    BatchPurchaceHandler,
+    InsufficientFunds,
+    InvalidAmount,
+    OrderProcessor,
+    OutboxDispatcher,
+    Portfolio,
+    PurchaceHandler,
+    TransferHandler,
+    TreasuryPurchaceHandler,
+    TreasuryReplenisher,
+)
+from core.views import Buy
 
-from .models import Currency, Exchange, TreasuryBalance, UserBalance
+from .models import (
+    Currency,
+    Exchange,
+    ExchangeCommand,
+    IdempotencyKey,
+    LedgerEntry,
+    LedgerSnapshot,
+    Order,
+    PriceVersion,
+    TreasuryBalance,
+    TreasuryDemand,
+    UserBalance,
+    currency_cache,
+    idempotency_cache,
+)
 
 User = get_user_model()
 
@@ -59,9 +135,8 @@ class ExchangeModelTest(TestCase):
         symbol = "TEST"
         exchange.buy_from_exchange(amount, symbol)
 
-        # Check if the TreasuryBalance for the currency was created and updated correctly
-        treasury_balance = TreasuryBalance.objects.get(currency=self.currency)
-        self.assertEqual(treasury_balance.amount, amount)
+        # Check if the treasury holding of the currency was credited
+        self.assertEqual(TreasuryBalance.total(self.currency), amount)
 
     def test_buy_from_exchange_insufficient_funds(self):
         # Create an exchange
@@ -92,9 +167,8 @@ class ExchangeModelTest(TestCase):
         symbol = "TEST"
         exchange.buy_from_exchange(amount, symbol)
 
-        # Check if the existing TreasuryBalance was updated correctly
-        updated_balance = TreasuryBalance.objects.get(currency=self.currency)
-        self.assertEqual(updated_balance.amount, Decimal("150.0"))
+        # Check if the fill was added to the existing holding
+        self.assertEqual(TreasuryBalance.total(self.currency), Decimal("150.0"))
 
     def test_buy_from_exchange_currency_not_existing(self):
         # Define the parameters for a new currency
@@ -106,6 +180,82 @@ class ExchangeModelTest(TestCase):
             exchange.buy_from_exchange(amount, symbol)
 
 
+class CrossCurrencyTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="pass")
+        self.usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=20000
+        )
+        self.eth = Currency.objects.create(
+            display_name="Ether", ticker_symbol="ETH", dollar_value=2000
+        )
+        UserBalance.objects.create(user=self.user, currency=self.btc, amount=1)
+        Exchange.objects.create(title="Binance")
+        self.client.force_login(self.user)
+
+    def balance(self, currency):
+        return UserBalance.objects.get(user=self.user, currency=currency).amount
+
+    def test_pay_with(self):
+        response = self.client.post(
+            "/buy/", {"symbol": "ETH", "amount": "5", "pay_with": "BTC"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.balance(self.btc), Decimal("0.5"))
+        self.assertEqual(self.balance(self.eth), 5)
+        self.assertEqual(TreasuryBalance.total(self.btc), Decimal("0.5"))
+        self.assertEqual(TreasuryBalance.total(self.eth), -5)
+        self.assertEqual(LedgerEntry.balance_of(self.btc, self.user), Decimal("-0.5"))
+
+        response = self.client.post(
+            "/buy/", {"symbol": "ETH", "amount": "6", "pay_with": "BTC"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post(
+            "/buy/", {"symbol": "ETH", "amount": "1", "pay_with": "ETH"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            "/buy/",
+            {"symbol": "ETH", "amount": "1", "pay_with": "BTC"},
+            HTTP_PREFER="respond-async",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_pay_with(self):
+        response = self.client.post(
+            "/buy/batch/",
+            [
+                {"symbol": "ETH", "amount": "2", "pay_with": "BTC"},
+                {"symbol": "ETH", "amount": "1", "pay_with": "NOPE"},
+                {"symbol": "BTC", "amount": "1"},
+            ],
+            content_type="application/json",
+        )
+        self.assertEqual(
+            [result["status"] for result in response.json()], [201, 404, 403]
+        )
+        self.assertEqual(self.balance(self.btc), Decimal("0.8"))
+        self.assertEqual(self.balance(self.eth), 2)
+
+    def test_cross_rates(self):
+        self.assertEqual(self.btc.rate(self.eth), 10)
+        self.assertEqual(self.eth.rate(self.btc), Decimal("0.1"))
+        free = Currency(ticker_symbol="FREE", dollar_value=0)
+        with self.assertRaises(Currency.DoesNotExist):
+            self.btc.rate(free)
+
+    def test_quotes_are_paid_in_usd(self):
+        response = self.client.post(
+            "/quote/", {"symbol": "ETH", "amount": "1", "pay_with": "BTC"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {"error": "Quotes are paid in USD."})
+
+
 class TreasuryBalanceTestCase(TestCase):
     def setUp(self):
         # Create a sample currency for testing
@@ -239,22 +389,52 @@ class PurchaseHandlerTestCase(TestCase):
         self.assertAlmostEqual(user_balance_in_usd.amount, Decimal(50000.0), places=4)
 
         # Check if the treasury balance for USD has increased
-        treasury_balance_in_usd = TreasuryBalance.objects.get(
-            currency=self.base_currency
-        )
         self.assertAlmostEqual(
-            treasury_balance_in_usd.amount,
-            Decimal(
-                50000.0,
-            ),
-            places=4,
+            TreasuryBalance.total(self.base_currency), Decimal(50000.0), places=4
         )
 
         # Check if the treasury balance for BTC has decreased
-        treasury_balance_in_btc = TreasuryBalance.objects.get(
-            currency=self.currency_to_purchase
+        self.assertAlmostEqual(
+            TreasuryBalance.total(self.currency_to_purchase), Decimal(-2), places=4
+        )
+
+        # The debt is settled in the background
+        orders = TreasuryReplenisher(exchange=self.exchange).run_once()
+        self.assertEqual(orders, [("BTC", 2)])
+        self.assertAlmostEqual(
+            TreasuryBalance.total(self.currency_to_purchase), Decimal(0), places=4
+        )
+
+    @override_settings(TREASURY_REPLENISH_INLINE=True)
+    def test_purchase_replenishes_inline(self):
+        handler = PurchaceHandler(self.user, "BTC", 2, self.exchange)
+        with self.captureOnCommitCallbacks(execute=True):
+            response, response_status = handler.execute()
+        self.assertEqual(response_status, status.HTTP_201_CREATED)
+        self.assertAlmostEqual(
+            TreasuryBalance.total(self.currency_to_purchase), Decimal(0), places=4
+        )
+
+    @override_settings(TREASURY_REPLENISH_INLINE=True, EXCHANGE_RETRIES=0)
+    def test_failed_replenishment_keeps_the_purchase(self):
+        server = MockExchangeServer(failure_rate=1)
+        server.start()
+        self.addCleanup(server.stop)
+        self.exchange.adapter = Exchange.Adapter.HTTP
+        self.exchange.url = server.url
+        self.exchange.save()
+
+        handler = PurchaceHandler(self.user, "BTC", 2, self.exchange)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response, response_status = handler.execute()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(response_status, status.HTTP_201_CREATED)
+        self.assertEqual(
+            UserBalance.objects.get(user=self.user, currency=self.base_currency).amount,
+            Decimal(50000),
         )
-        self.assertAlmostEqual(treasury_balance_in_btc.amount, Decimal(0), places=4)
+        # Left for the background replenisher
+        self.assertEqual(TreasuryBalance.total(self.currency_to_purchase), -2)
 
     def test_successful_purchase_small_amount(self):
         initial_user_base_balance, _ = UserBalance.objects.get_or_create(
@@ -275,7 +455,7 @@ class PurchaseHandlerTestCase(TestCase):
         # Simulate a valid purchase request
         handler = PurchaceHandler(self.user, "BTC", Decimal(0.0001), self.exchange)
         response, response_status = handler.execute()
-        
+
         self.assertEqual(response_status, status.HTTP_201_CREATED)
         self.assertEqual(response, {"message": "Purchase successful."})
 
@@ -300,21 +480,1982 @@ class PurchaseHandlerTestCase(TestCase):
         )
 
         # Check if the treasury balance for USD has increased
-        treasury_balance_in_usd = TreasuryBalance.objects.get(
-            currency=self.base_currency
-        )
         self.assertAlmostEqual(
-            treasury_balance_in_usd.amount,
+            TreasuryBalance.total(self.base_currency),
             Decimal(initial_treasury_balance_in_usd.amount) + Decimal(2.5),
             places=4,
         )
 
         # Check if the treasury balance for BTC has decreased
-        treasury_balance_in_btc = TreasuryBalance.objects.get(
-            currency=self.currency_to_purchase
-        )
         self.assertAlmostEqual(
-            treasury_balance_in_btc.amount,
+            TreasuryBalance.total(self.currency_to_purchase),
             Decimal(initial_treasury_balance_in_btc.amount) - Decimal(0.0001),
             places=4,
         )
+
+    def test_purchase_insufficient_funds(self):
+        # 5 BTC costs 125,000 USD, user only has 100,000 USD
+        handler = PurchaceHandler(self.user, "BTC", 5, self.exchange)
+        response, response_status = handler.execute()
+        self.assertEqual(response_status, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response, {"error": "Insufficient Funds!"})
+
+        # Nothing should have been transfered
+        self.user_base_balance.refresh_from_db()
+        self.assertEqual(self.user_base_balance.amount, Decimal(100000))
+        self.assertFalse(
+            UserBalance.objects.filter(
+                user=self.user, currency=self.currency_to_purchase
+            ).exists()
+        )
+
+
+class TransferHandlerTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.currency = Currency.objects.create(
+            display_name="Test Currency",
+            ticker_symbol="TEST",
+            dollar_value=Decimal("1.0"),
+        )
+        self.handler = TransferHandler(user=self.user, currency=self.currency)
+
+    def test_transfer_creates_missing_balances(self):
+        self.handler.transfer_from_treasury_to_user(Decimal("3.5"))
+
+        user_balance = UserBalance.objects.get(user=self.user, currency=self.currency)
+        self.assertEqual(user_balance.amount, Decimal("3.5"))
+        self.assertEqual(TreasuryBalance.total(self.currency), Decimal("-3.5"))
+
+    def test_transfer_from_user_insufficient_funds(self):
+        UserBalance.objects.create(
+            user=self.user, currency=self.currency, amount=Decimal("1.0")
+        )
+        with self.assertRaises(InsufficientFunds):
+            self.handler.transfer_from_user_to_treasury(Decimal("1.5"))
+
+        user_balance = UserBalance.objects.get(user=self.user, currency=self.currency)
+        self.assertEqual(user_balance.amount, Decimal("1.0"))
+        self.assertFalse(TreasuryBalance.objects.exists())
+
+    def test_transfer_rejects_non_positive_amounts(self):
+        UserBalance.objects.create(
+            user=self.user, currency=self.currency, amount=Decimal("1.0")
+        )
+        for amount in (Decimal("-1.0"), Decimal(0), Decimal("0.0000001")):
+            with self.assertRaises(InvalidAmount):
+                self.handler.transfer_from_user_to_treasury(amount)
+            with self.assertRaises(InvalidAmount):
+                self.handler.transfer_from_treasury_to_user(amount)
+
+        user_balance = UserBalance.objects.get(user=self.user, currency=self.currency)
+        self.assertEqual(user_balance.amount, Decimal("1.0"))
+        self.assertFalse(LedgerEntry.objects.exists())
+
+    def test_transfer_does_not_use_stale_instances(self):
+        user_balance = UserBalance.objects.create(
+            user=self.user, currency=self.currency, amount=Decimal("10.0")
+        )
+        TreasuryBalance.objects.create(currency=self.currency, amount=Decimal("0"))
+
+        # Another worker changes the balance after we loaded it
+        UserBalance.objects.filter(pk=user_balance.pk).update(amount=Decimal("20.0"))
+        user_balance.increase_amount(Decimal("1.0"))
+        self.assertEqual(user_balance.amount, Decimal("21.0"))
+
+        self.handler.transfer_from_user_to_treasury(Decimal("5.0"))
+        user_balance.refresh_from_db()
+        self.assertEqual(user_balance.amount, Decimal("16.0"))
+
+    def test_transfer_query_count(self):
+        UserBalance.objects.create(
+            user=self.user, currency=self.currency, amount=Decimal("10.0")
+        )
+        TreasuryBalance.objects.create(currency=self.currency, amount=Decimal("0"))
+
+        # One UPDATE of the user's balance, one ledger INSERT, plus the
+        # savepoint pair; the treasury row isn't touched
+        with self.assertNumQueries(4):
+            self.handler.transfer_from_user_to_treasury(Decimal("5.0"))
+
+
+class BatchPurchaseTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.base_currency = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1.0
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=25000.0
+        )
+        self.eth = Currency.objects.create(
+            display_name="Ethereum", ticker_symbol="ETH", dollar_value=2000.0
+        )
+        UserBalance.objects.create(
+            user=self.user, currency=self.base_currency, amount=30000.0
+        )
+        TreasuryBalance.objects.create(currency=self.btc, amount=10)
+        TreasuryBalance.objects.create(currency=self.eth, amount=10)
+        self.exchange = Exchange.objects.create(title="Binance")
+        self.client.force_login(self.user)
+
+    def test_batch_purchase(self):
+        orders = [
+            {"symbol": "BTC", "amount": "1"},
+            {"symbol": "ETH", "amount": "2"},
+            {"symbol": "BTC", "amount": "1"},  # Not enough USD left for this one
+            {"symbol": "NOPE", "amount": "1"},
+        ]
+        response = self.client.post(
+            "/buy/batch/", orders, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result["status"] for result in response.json()],
+            [
+                status.HTTP_201_CREATED,
+                status.HTTP_201_CREATED,
+                status.HTTP_403_FORBIDDEN,
+                status.HTTP_404_NOT_FOUND,
+            ],
+        )
+
+        balances = {
+            balance.currency.ticker_symbol: balance.amount
+            for balance in UserBalance.objects.filter(user=self.user)
+        }
+        self.assertEqual(
+            balances, {"USD": Decimal(1000), "BTC": Decimal(1), "ETH": Decimal(2)}
+        )
+        self.assertEqual(TreasuryBalance.total(self.base_currency), Decimal(29000))
+        self.assertEqual(TreasuryBalance.total(self.btc), 9)
+        self.assertEqual(TreasuryBalance.total(self.eth), 8)
+
+    def test_batch_query_count_does_not_grow(self):
+        orders = [{"symbol": "ETH", "amount": Decimal("0.001")}] * 10
+        # Creates the missing balance rows
+        BatchPurchaceHandler(self.user, orders, self.exchange).execute()
+
+        handler = BatchPurchaceHandler(self.user, orders, self.exchange)
+        with CaptureQueriesContext(connection) as small_batch:
+            handler.execute()
+
+        handler = BatchPurchaceHandler(self.user, orders * 10, self.exchange)
+        with CaptureQueriesContext(connection) as large_batch:
+            handler.execute()
+
+        # Only the chunking of the bulk inserts depends on the batch size
+        self.assertLessEqual(len(large_batch), len(small_batch) + 2)
+
+    def test_batch_validation(self):
+        response = self.client.post("/buy/batch/", [], content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            "/buy/batch/", [{"symbol": "BTC"}], content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_non_positive_amounts_are_rejected(self):
+        for amount in ("-1", "0"):
+            response = self.client.post(
+                "/buy/batch/",
+                [{"symbol": "BTC", "amount": amount}],
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.post("/buy/", {"symbol": "BTC", "amount": amount})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.post("/quote/", {"symbol": "BTC", "amount": amount})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Orders that skip the serializer, eg. from process_orders
+        results, _ = BatchPurchaceHandler(
+            self.user, [{"symbol": "BTC", "amount": Decimal(-1)}], self.exchange
+        ).execute()
+        self.assertEqual(results[0]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(UserBalance.objects.get(user=self.user).amount, Decimal(30000))
+        self.assertFalse(LedgerEntry.objects.exists())
+
+
+class CurrencyCacheTestCase(TestCase):
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=25000.0
+        )
+
+    def test_cached_lookup_does_not_query(self):
+        currency_cache.get("BTC")
+        with self.assertNumQueries(0):
+            self.assertEqual(currency_cache.get("BTC"), self.currency)
+
+    def test_missing_currency(self):
+        with self.assertRaises(Currency.DoesNotExist):
+            currency_cache.get("NOPE")
+
+    def test_save_invalidates_cache(self):
+        currency_cache.get("BTC")
+        self.currency.dollar_value = Decimal("30000")
+        self.currency.save()
+        self.assertEqual(currency_cache.get("BTC").dollar_value, Decimal("30000"))
+
+    @override_settings(CURRENCY_CACHE_TTL=0)
+    def test_change_from_other_worker_is_picked_up(self):
+        currency_cache.get("BTC")
+
+        # Another process updates the price, no signal reaches this one
+        Currency.objects.filter(pk=self.currency.pk).update(dollar_value=30000)
+        PriceVersion.bump()
+
+        self.assertEqual(currency_cache.get("BTC").dollar_value, Decimal("30000"))
+
+
+class TreasuryReplenisherTestCase(TestCase):
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value=2
+        )
+        self.treasury_balance = TreasuryBalance.objects.create(
+            currency=self.currency, amount=0
+        )
+        self.exchange = Exchange.objects.create(title="Binance")
+        self.now = 0
+        self.replenisher = TreasuryReplenisher(
+            exchange=self.exchange, flush_value=100, max_wait=5, clock=lambda: self.now
+        )
+
+    def test_small_debts_are_aggregated(self):
+        # 20 dollars of debt, above the exchange minimum but below flush_value
+        self.treasury_balance.decrease_amount(10)
+        self.assertEqual(self.replenisher.run_once(), [])
+
+        self.treasury_balance.decrease_amount(45)
+        self.assertEqual(self.replenisher.run_once(), [("TEST", 55)])
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+
+    def test_old_debt_is_flushed(self):
+        self.treasury_balance.decrease_amount(10)
+        self.assertEqual(self.replenisher.run_once(), [])
+
+        self.now = 5
+        self.assertEqual(self.replenisher.run_once(), [("TEST", 10)])
+        self.assertEqual(self.replenisher.run_once(), [])
+
+    def test_debt_below_threshold_is_ignored(self):
+        self.treasury_balance.decrease_amount(1)
+        self.now = 60
+        self.assertEqual(self.replenisher.run_once(), [])
+
+
+@override_settings(TREASURY_REPLENISH_OUTBOX=True)
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="pass")
+        self.base_currency = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value=10
+        )
+        UserBalance.objects.create(
+            user=self.user, currency=self.base_currency, amount=1000
+        )
+        self.exchange = Exchange.objects.create(title="Binance")
+
+    def buy(self, amount):
+        handler = PurchaceHandler(self.user, "TEST", amount, self.exchange)
+        self.assertEqual(handler.execute()[1], status.HTTP_201_CREATED)
+
+    def use_mock_exchange(self, **kwargs):
+        server = MockExchangeServer(**kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        self.exchange.adapter = Exchange.Adapter.HTTP
+        self.exchange.url = server.url
+        self.exchange.save()
+        return server
+
+    @override_settings(TREASURY_REPLENISH_INLINE=True)
+    def test_buys_are_folded_into_one_command(self):
+        self.buy(3)
+        self.buy(2)
+        command = ExchangeCommand.objects.get()
+        self.assertEqual(command.status, ExchangeCommand.Status.PENDING)
+        self.assertEqual(command.currency, self.currency)
+        # The outbox takes precedence, nothing was bought inline
+        self.assertEqual(TreasuryBalance.total(self.currency), -5)
+
+    def test_batch_buys_write_commands(self):
+        handler = BatchPurchaceHandler(
+            self.user,
+            [{"symbol": "TEST", "amount": 3}, {"symbol": "NOPE", "amount": 1}],
+            self.exchange,
+        )
+        handler.execute()
+        self.assertEqual(
+            list(ExchangeCommand.objects.values_list("currency", flat=True)),
+            [self.currency.pk],
+        )
+
+    def test_dispatch_settles_debt(self):
+        self.buy(3)
+        dispatcher = OutboxDispatcher(self.exchange)
+        self.assertEqual(dispatcher.process_batch(), 1)
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+        command = ExchangeCommand.objects.get()
+        self.assertEqual(command.status, ExchangeCommand.Status.DONE)
+        self.assertEqual(command.attempts, 1)
+        self.assertEqual(dispatcher.process_batch(), 0)
+
+        # The next buy gets a command of its own
+        self.buy(1)
+        self.buy(1)
+        self.assertEqual(dispatcher.process_batch(), 1)
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+
+    def test_settled_debt_is_not_bought_again(self):
+        self.buy(3)
+        self.exchange.buy_from_exchange(amount=3, symbol="TEST")
+        OutboxDispatcher(self.exchange).process_batch()
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+        self.assertEqual(
+            ExchangeCommand.objects.get().status, ExchangeCommand.Status.DONE
+        )
+
+    def test_expired_claim_is_filled_once(self):
+        server = self.use_mock_exchange()
+        self.buy(3)
+
+        # A dispatcher places the order, then dies before recording it
+        crashed = OutboxDispatcher(self.exchange, lease=0)
+        (command,) = crashed.claim()
+        self.exchange.place_order(3, "TEST", client_order_id=command.order_id.hex)
+
+        retrying = OutboxDispatcher(self.exchange, lease=0)
+        (retried,) = retrying.claim()
+        self.assertEqual(retried.order_id, command.order_id)
+        self.assertTrue(retrying.dispatch(retried))
+        self.assertEqual(len(server.orders), 1)
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+
+        # The lapsed claim can't complete the command a second time
+        self.assertFalse(crashed.dispatch(command))
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+
+    def test_claimed_currency_is_not_bought_twice(self):
+        server = self.use_mock_exchange()
+        self.buy(3)
+        first = OutboxDispatcher(self.exchange)
+        (command,) = first.claim()
+
+        # A buy while the command is in flight gets a command of its own,
+        # which waits until the first one is done
+        self.buy(1)
+        second = OutboxDispatcher(self.exchange)
+        self.assertEqual(second.claim(), [])
+
+        self.assertTrue(first.dispatch(command))
+        self.assertEqual(second.process_batch(), 1)
+        # The first order covered both buys
+        self.assertEqual(len(server.orders), 1)
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2, EXCHANGE_RETRIES=0)
+    def test_failing_command_is_given_up(self):
+        self.use_mock_exchange(failure_rate=1)
+        self.buy(3)
+        dispatcher = OutboxDispatcher(self.exchange, lease=0)
+
+        dispatcher.process_batch()
+        command = ExchangeCommand.objects.get()
+        self.assertEqual(command.status, ExchangeCommand.Status.CLAIMED)
+        self.assertIn("failed", command.error)
+
+        dispatcher.process_batch()
+        command.refresh_from_db()
+        self.assertEqual(command.status, ExchangeCommand.Status.FAILED)
+        self.assertEqual(dispatcher.process_batch(), 0)
+
+
+class ReplenishmentPolicyTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="pass")
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value=2
+        )
+        self.exchange = Exchange.objects.create(title="Binance")
+
+    def sell(self, amount):
+        TransferHandler(
+            user=self.user, currency=self.currency
+        ).transfer_from_treasury_to_user(Decimal(amount))
+
+    def rewind(self, seconds):
+        """Pretends the last observation was `seconds` earlier."""
+        TreasuryDemand.objects.update(
+            observed_at=F("observed_at") - timedelta(seconds=seconds)
+        )
+
+    def test_per_currency_threshold(self):
+        self.currency.treasury_threshold = 100
+        self.currency.save()
+        self.sell(40)
+        TreasuryPurchaceHandler(currency_cache.get("TEST")).purchase_if_necessary(
+            self.exchange
+        )
+        self.assertEqual(TreasuryBalance.total(self.currency), -40)
+
+        self.sell(10)
+        TreasuryPurchaceHandler(currency_cache.get("TEST")).purchase_if_necessary(
+            self.exchange
+        )
+        self.assertEqual(TreasuryBalance.total(self.currency), 0)
+
+    def test_orders_are_raised_to_the_exchange_minimum(self):
+        self.currency.treasury_threshold = 1
+        self.currency.save()
+        self.sell(1)
+        TreasuryPurchaceHandler(currency_cache.get("TEST")).purchase_if_necessary(
+            self.exchange
+        )
+        # MINIMUM_ORDER_USD_VALUE at 2 USD a unit
+        self.assertEqual(
+            TreasuryBalance.total(self.currency),
+            math.ceil(settings.MINIMUM_ORDER_USD_VALUE / 2) - 1,
+        )
+
+    def test_buy_rate(self):
+        self.sell(5)
+        self.assertEqual(TreasuryDemand.observe(half_life=60), {})
+        # 60 units in 60 seconds, weighted half against the initial rate of 0
+        self.sell(60)
+        self.rewind(60)
+        rate = TreasuryDemand.observe(half_life=60)[self.currency.pk]
+        self.assertAlmostEqual(rate, 0.5, places=3)
+
+        # No sales for a half life, the rate halves
+        self.rewind(60)
+        rate = TreasuryDemand.observe(half_life=60)[self.currency.pk]
+        self.assertAlmostEqual(rate, 0.25, places=3)
+
+    @override_settings(TREASURY_REPLENISH_HORIZON=100, TREASURY_DEMAND_HALF_LIFE=60)
+    def test_orders_cover_the_horizon(self):
+        TreasuryDemand.observe()
+        self.sell(60)
+        self.rewind(60)
+
+        orders = TreasuryReplenisher(self.exchange, max_wait=0).run_once()
+        # The debt, plus 100 seconds at half a unit per second
+        self.assertEqual(orders, [("TEST", 110)])
+        self.assertEqual(TreasuryBalance.total(self.currency), 50)
+
+        # Buys are served from stock, without going back to the exchange
+        self.sell(40)
+        self.assertEqual(TreasuryReplenisher(self.exchange).run_once(), [])
+
+
+class LedgerTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value=2
+        )
+        self.handler = TransferHandler(user=self.user, currency=self.currency)
+
+    def test_transfers_are_recorded(self):
+        self.handler.transfer_from_treasury_to_user(Decimal("3"))
+        self.handler.transfer_from_user_to_treasury(Decimal("1"))
+
+        self.assertEqual(LedgerEntry.objects.count(), 4)
+        self.assertEqual(
+            LedgerEntry.balance_of(self.currency, user=self.user), Decimal("2")
+        )
+        self.assertEqual(LedgerEntry.balance_of(self.currency), Decimal("-2"))
+
+    def test_failed_transfer_is_not_recorded(self):
+        with self.assertRaises(InsufficientFunds):
+            self.handler.transfer_from_user_to_treasury(Decimal("1"))
+        self.assertFalse(LedgerEntry.objects.exists())
+
+    def test_compaction(self):
+        self.handler.transfer_from_treasury_to_user(Decimal("3"))
+        last_entry_id = LedgerSnapshot.compact(older_than=0)
+        self.assertEqual(last_entry_id, LedgerEntry.objects.latest("id").id)
+
+        snapshot = LedgerSnapshot.objects.get(user=self.user, currency=self.currency)
+        self.assertEqual(snapshot.amount, Decimal("3"))
+
+        # Balance is snapshot plus entries written after it
+        self.handler.transfer_from_user_to_treasury(Decimal("1"))
+        self.assertEqual(
+            LedgerEntry.balance_of(self.currency, user=self.user), Decimal("2")
+        )
+
+        LedgerSnapshot.compact(older_than=0)
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.amount, Decimal("2"))
+        self.assertEqual(LedgerSnapshot.objects.get(user=None).amount, Decimal("-2"))
+
+    def test_compaction_only_rolls_changed_accounts(self):
+        other_user = User.objects.create_user(username="other", password="pass")
+        other = TransferHandler(user=other_user, currency=self.currency)
+        other.transfer_from_treasury_to_user(Decimal("5"))
+        first = LedgerSnapshot.compact(older_than=0)
+
+        self.handler.transfer_from_treasury_to_user(Decimal("3"))
+        last = LedgerSnapshot.compact(older_than=0, batch_size=1)
+        self.assertEqual(
+            dict(LedgerSnapshot.objects.values_list("user", "last_entry_id")),
+            {other_user.pk: first, self.user.pk: last, None: last},
+        )
+        self.assertEqual(LedgerEntry.balance_of(self.currency, other_user), 5)
+        self.assertEqual(LedgerEntry.balance_of(self.currency), -8)
+        self.assertEqual(TreasuryBalance.total(self.currency), -8)
+
+    def test_admin_edits_are_recorded(self):
+        admin = User.objects.create_superuser(username="admin", password="pass")
+        self.client.force_login(admin)
+        self.handler.transfer_from_treasury_to_user(Decimal("3"))
+        balance = UserBalance.objects.get(user=self.user)
+        response = self.client.post(
+            f"/admin/core/userbalance/{balance.pk}/change/", {"amount": "10"}
+        )
+        self.assertEqual(response.status_code, 302)
+        balance.refresh_from_db()
+        self.assertEqual(balance.amount, 10)
+        self.assertEqual(LedgerEntry.balance_of(self.currency, self.user), 10)
+
+        LedgerSnapshot.compact(older_than=0)
+        treasury = TreasuryBalance.objects.get()
+        response = self.client.post(
+            f"/admin/core/treasurybalance/{treasury.pk}/change/", {"amount": "4"}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(TreasuryBalance.total(self.currency), 4)
+        self.assertEqual(LedgerEntry.balance_of(self.currency), 4)
+
+    def test_loaded_balances_are_recorded(self):
+        fixture = os.path.join(tempfile.mkdtemp(), "balances.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(fixture))
+        with open(fixture, "w") as f:
+            json.dump(
+                [
+                    {
+                        "model": "core.userbalance",
+                        "pk": 1,
+                        "fields": {
+                            "user": self.user.pk,
+                            "currency": self.currency.pk,
+                            "amount": "100",
+                        },
+                    },
+                    {
+                        "model": "core.treasurybalance",
+                        "pk": 1,
+                        "fields": {"currency": self.currency.pk, "amount": "1000"},
+                    },
+                ],
+                f,
+            )
+        call_command("loaddata", fixture, verbosity=0)
+        self.assertEqual(LedgerEntry.balance_of(self.currency, self.user), 100)
+        self.assertEqual(LedgerEntry.balance_of(self.currency), 1000)
+        self.assertEqual(TreasuryBalance.total(self.currency), 1000)
+
+        LedgerSnapshot.compact(older_than=0)
+        self.assertEqual(TreasuryBalance.objects.get().amount, 1000)
+        self.assertEqual(TreasuryBalance.total(self.currency), 1000)
+
+    def test_compaction_skips_recent_entries(self):
+        self.handler.transfer_from_treasury_to_user(Decimal("3"))
+        self.assertEqual(LedgerSnapshot.compact(older_than=60), 0)
+        self.assertFalse(LedgerSnapshot.objects.exists())
+
+
+class AsyncPurchaseTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.base_currency = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1.0
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=25000.0
+        )
+        UserBalance.objects.create(
+            user=self.user, currency=self.base_currency, amount=30000.0
+        )
+        self.exchange = Exchange.objects.create(title="Binance")
+
+    def test_async_handler(self):
+        handler = AsyncPurchaceHandler(self.user, "BTC", Decimal(1), self.exchange)
+        response, response_status = async_to_sync(handler.execute)()
+        self.assertEqual(response_status, status.HTTP_201_CREATED)
+        self.assertEqual(
+            UserBalance.objects.get(user=self.user, currency=self.btc).amount, 1
+        )
+
+        handler = AsyncPurchaceHandler(self.user, "BTC", Decimal(1), self.exchange)
+        response, response_status = async_to_sync(handler.execute)()
+        self.assertEqual(response_status, status.HTTP_403_FORBIDDEN)
+
+        handler = AsyncPurchaceHandler(self.user, "NOPE", Decimal(1), self.exchange)
+        response, response_status = async_to_sync(handler.execute)()
+        self.assertEqual(response_status, status.HTTP_404_NOT_FOUND)
+
+    def test_async_view(self):
+        order = {"symbol": "BTC", "amount": "1"}
+        response = self.client.post("/buy/async/", order)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_login(self.user)
+        response = self.client.post("/buy/async/", order)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {"message": "Purchase successful."})
+
+        response = self.client.post("/buy/async/", {"symbol": "BTC"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_benchmark_run(self):
+        benchmark = Benchmark(users=3, currencies=2)
+        benchmark.seed()
+        results = benchmark.run(benchmark.generate_requests(10), concurrency=1)
+
+        self.assertEqual(results["requests"], 10)
+        self.assertEqual(results["status_codes"], {"201": 10})
+        self.assertEqual(results["lock_errors"], 0)
+        self.assertGreater(results["queries_per_request"], 0)
+        self.assertLessEqual(results["latency_ms"]["p50"], results["latency_ms"]["p99"])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0)
+
+
+class SeedTestCase(TestCase):
+    def dataset(self, prefix):
+        return list(
+            UserBalance.objects.filter(user__username__startswith=f"{prefix}-")
+            .order_by("user__username", "currency__ticker_symbol")
+            .values_list("user__username", "amount")
+        )
+
+    def test_seed(self):
+        rows = Seeder(users=7, currencies=4, holdings=2, chunk_size=3).run()
+        self.assertEqual(rows["auth.User"], 7)
+        self.assertEqual(rows["core.Currency"], 4)
+        self.assertEqual(rows["core.UserBalance"], 7 * 3)
+        self.assertNotIn("core.TreasuryBalance", rows)
+        self.assertEqual(rows["core.LedgerEntry"], 7 * 3 + 4)
+
+        # The opening ledger entries agree with the balances
+        for balance in UserBalance.objects.all()[:5]:
+            self.assertEqual(
+                LedgerEntry.balance_of(balance.currency, balance.user), balance.amount
+            )
+        currency = Currency.objects.get(ticker_symbol="SE3")
+        self.assertEqual(
+            LedgerEntry.balance_of(currency), TreasuryBalance.total(currency)
+        )
+        self.assertGreater(TreasuryBalance.total(currency), 0)
+
+    def test_seed_is_deterministic(self):
+        Seeder(users=5, currencies=3, seed=1, prefix="aa").run()
+        Seeder(users=5, currencies=3, seed=1, prefix="bb").run()
+        first, second = self.dataset("aa"), self.dataset("bb")
+        self.assertEqual(len(first), 5 * 4)
+        self.assertEqual(
+            [amount for _, amount in first], [amount for _, amount in second]
+        )
+
+    def test_seed_command(self):
+        call_command("seed", users=2, currencies=1, stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith="seed-").count(), 2)
+        with self.assertRaises(CommandError):
+            call_command("seed", users=2, currencies=1, stdout=StringIO())
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="finance", is_staff=True)
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value=2
+        )
+        for i in range(5):
+            user = User.objects.create_user(username=f"user-{i}")
+            TransferHandler(
+                user=user, currency=self.currency
+            ).transfer_from_treasury_to_user(Decimal("1.5") * (i + 1))
+        self.client.force_login(self.user)
+
+    def content(self, response):
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def test_jsonl(self):
+        with self.settings(EXPORT_CHUNK_SIZE=2):
+            response = self.client.get("/export/balances/")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response["Content-Type"], "application/jsonl; charset=utf-8"
+            )
+            lines = self.content(response).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(
+            json.loads(lines[-1]),
+            {
+                "id": UserBalance.objects.latest("pk").pk,
+                "user_id": User.objects.get(username="user-4").pk,
+                "username": "user-4",
+                "currency": "TEST",
+                "amount": "7.500000",
+            },
+        )
+
+    def test_csv_gzip(self):
+        response = self.client.get(
+            "/export/transfers/?format=csv", HTTP_ACCEPT_ENCODING="gzip, deflate"
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertIn('filename="transfers.csv"', response["Content-Disposition"])
+        rows = list(
+            csv.DictReader(
+                io.StringIO(gzip.decompress(self.content(response)).decode())
+            )
+        )
+        # A treasury and a user entry per transfer
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[2]["username"], "")
+        self.assertEqual(rows[2]["amount"], "-3.000000")
+        self.assertEqual(rows[3]["username"], "user-1")
+        self.assertEqual(rows[3]["amount"], "3.000000")
+
+    def test_access(self):
+        self.assertEqual(
+            self.client.get("/export/nope/").status_code, status.HTTP_404_NOT_FOUND
+        )
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(
+            self.client.get("/export/treasury/").status_code,
+            status.HTTP_403_FORBIDDEN,
+        )
+
+    def test_asgi_streams_asynchronously(self):
+        client = AsyncClient()
+        client.force_login(self.user)
+
+        async def export():
+            response = await client.get("/export/transfers/")
+            self.assertTrue(response.is_async)
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(
+            async_to_sync(export)(),
+            self.content(self.client.get("/export/transfers/")),
+        )
+
+    def test_export_command(self):
+        path = os.path.join(tempfile.mkdtemp(), "treasury.csv.gz")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command("export", "treasury", format="csv", gzip=True, output=path)
+        with gzip.open(path, "rt") as export:
+            self.assertEqual(
+                export.read().splitlines(),
+                ["currency,amount", "TEST,-22.500000"],
+            )
+
+
+class MetricsTestCase(TestCase):
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Test.", (0.1, 1))
+        histogram.observe(0.05, view="a")
+        histogram.observe(0.5, view="a")
+        histogram.observe(5, view="a")
+        HISTOGRAMS.remove(histogram)
+
+        self.assertEqual(
+            histogram.render(),
+            [
+                "# HELP test_seconds Test.",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{view="a",le="0.1"} 1',
+                'test_seconds_bucket{view="a",le="1"} 2',
+                'test_seconds_bucket{view="a",le="+Inf"} 3',
+                'test_seconds_sum{view="a"} 5.55',
+                'test_seconds_count{view="a"} 3',
+            ],
+        )
+
+    def test_metrics_endpoint(self):
+        user = User.objects.create_user(username="testuser", password="testpass")
+        self.client.force_login(user)
+        self.client.get("/buy/")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = response.content.decode()
+        self.assertIn('abanex_request_duration_seconds_count{view="buy-list"}', content)
+        self.assertIn('abanex_request_sql_queries_bucket{view="buy-list"', content)
+
+    def test_middleware_stays_async(self):
+        async def view(request):
+            request.resolver_match = SimpleNamespace(view_name="async-view")
+            return HttpResponse()
+
+        middleware = MetricsMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get("/"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(
+            'abanex_request_duration_seconds_count{view="async-view"} 1',
+            metrics.REQUEST_SECONDS.render(),
+        )
+
+    def test_asgi_counts_queries(self):
+        user = User.objects.create_user(username="testuser", password="testpass")
+        Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1.0
+        )
+        Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=25000.0
+        )
+        Exchange.objects.create(title="Binance")
+        client = AsyncClient()
+        client.force_login(user)
+
+        def queries(view):
+            prefix = f'abanex_request_sql_queries_sum{{view="{view}"}} '
+            for line in metrics.SQL_QUERIES.render():
+                if line.startswith(prefix):
+                    return float(line[len(prefix) :])
+            return 0
+
+        async def requests():
+            await client.get("/currencies/")
+            await client.post("/buy/async/", {"symbol": "BTC", "amount": "1"})
+
+        before = queries("currency-list"), queries("buy-async")
+        async_to_sync(requests)()
+        self.assertGreater(queries("currency-list"), before[0])
+        self.assertGreater(queries("buy-async"), before[1])
+
+
+class FixedPointTestCase(TestCase):
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value="1.5"
+        )
+
+    def test_conversions(self):
+        self.assertEqual(to_units(Decimal("1.5")), 1500000)
+        self.assertEqual(to_units(0.1), 100000)
+        self.assertEqual(to_units(3), 3000000)
+        self.assertEqual(from_units(-2500000), Decimal("-2.5"))
+        self.assertEqual(quantize(Decimal("0.0000015")), Decimal("0.000002"))
+
+    def test_amounts_are_stored_as_integers(self):
+        balance = TreasuryBalance.objects.create(
+            currency=self.currency, amount=Decimal("12.345678")
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT amount FROM core_treasurybalance WHERE id = %s", [balance.pk]
+            )
+            self.assertEqual(cursor.fetchone()[0], 12345678)
+
+        balance.refresh_from_db()
+        self.assertEqual(balance.amount, Decimal("12.345678"))
+
+    def test_large_amounts(self):
+        # Would not fit the former DecimalField(max_digits=12, decimal_places=4)
+        balance = TreasuryBalance.objects.create(
+            currency=self.currency, amount=Decimal("-1000000000000.5")
+        )
+        balance.increase_amount(Decimal("0.25"))
+        self.assertEqual(balance.amount, Decimal("-1000000000000.25"))
+        self.assertTrue(
+            TreasuryBalance.objects.filter(
+                amount__lt=Decimal("-1000000000000")
+            ).exists()
+        )
+
+
+class TokenTestCase(TestCase):
+    def setUp(self):
+        tokens.user_cache.clear()
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.basic = "Basic " + base64.b64encode(b"testuser:testpassword").decode()
+        self.usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        UserBalance.objects.create(user=self.user, currency=self.usd, amount=100)
+
+    def token(self):
+        response = self.client.post("/token/", HTTP_AUTHORIZATION=self.basic)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()["token_type"], "Bearer")
+        return response.json()["token"]
+
+    def get(self, path, token):
+        return self.client.get(path, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_token_skips_session_and_user_queries(self):
+        token = self.token()
+        self.assertEqual(
+            self.get("/portfolio/", token).json()["total_usd"], "100.000000"
+        )
+
+        # The user is in memory now, only the portfolio is queried
+        with CaptureQueriesContext(connection) as with_token:
+            self.assertEqual(self.get("/portfolio/", token).status_code, 200)
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as with_session:
+            self.assertEqual(self.client.get("/portfolio/").status_code, 200)
+        self.assertEqual(len(with_session), len(with_token) + 2)
+
+    def test_token_needs_no_csrf_token(self):
+        token = self.token()
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(
+            "/quote/",
+            {"symbol": "USD", "amount": "1"},
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_token_cannot_renew_itself(self):
+        token = self.token()
+        response = self.client.post("/token/", HTTP_AUTHORIZATION=f"Bearer {token}")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_invalid_tokens(self):
+        token = self.token()
+        response = self.get("/portfolio/", token[:-1])
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response["WWW-Authenticate"], "Bearer")
+        with self.settings(API_TOKEN_TTL=-1):
+            response = self.get("/portfolio/", token)
+        self.assertEqual(response.json()["detail"], "Token has expired.")
+        response = self.client.get("/portfolio/", HTTP_AUTHORIZATION="Bearer")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(API_TOKEN_USER_TTL=0)
+    def test_password_change_revokes_tokens(self):
+        token = self.token()
+        self.user.set_password("changed")
+        self.user.save()
+        response = self.get("/portfolio/", token)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.basic = "Basic " + base64.b64encode(b"testuser:changed").decode()
+        token = self.token()
+        self.assertEqual(self.get("/portfolio/", token).status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        response = self.get("/portfolio/", token)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class OrderTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.other_user = User.objects.create_user(
+            username="otheruser", password="testpassword"
+        )
+        self.base_currency = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1.0
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=25000.0
+        )
+        for user in (self.user, self.other_user):
+            UserBalance.objects.create(
+                user=user, currency=self.base_currency, amount=30000.0
+            )
+        self.exchange = Exchange.objects.create(title="Binance")
+        self.client.force_login(self.user)
+
+    def test_accept_order(self):
+        response = self.client.post(
+            "/buy/",
+            {"symbol": "BTC", "amount": "1"},
+            HTTP_PREFER="respond-async",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json()["status"], "pending")
+
+        # Nothing is transfered until the order is processed
+        self.assertFalse(UserBalance.objects.filter(currency=self.btc).exists())
+
+        self.assertEqual(OrderProcessor(self.exchange).process_batch(), 1)
+        response = self.client.get(response["Location"])
+        self.assertEqual(response.json()["status"], "filled")
+        self.assertEqual(
+            UserBalance.objects.get(user=self.user, currency=self.btc).amount, 1
+        )
+
+    def test_accept_unknown_currency(self):
+        response = self.client.post(
+            "/buy/",
+            {"symbol": "NOPE", "amount": "1"},
+            HTTP_PREFER="respond-async",
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Order.objects.exists())
+
+    def test_group_commit(self):
+        Order.objects.bulk_create(
+            [
+                Order(user=self.user, currency=self.btc, amount=1),
+                Order(user=self.other_user, currency=self.btc, amount=1),
+                Order(user=self.user, currency=self.btc, amount=1),
+            ]
+        )
+        processor = OrderProcessor(self.exchange, batch_size=2)
+        self.assertEqual(processor.process_batch(), 2)
+        self.assertEqual(processor.process_batch(), 1)
+        self.assertEqual(processor.process_batch(), 0)
+
+        self.assertEqual(
+            list(Order.objects.order_by("id").values_list("status", "error")),
+            [
+                ("filled", ""),
+                ("filled", ""),
+                ("rejected", "Insufficient Funds!"),
+            ],
+        )
+        self.assertEqual(TreasuryBalance.total(self.btc), -2)
+
+    def test_orders_are_private(self):
+        order = Order.objects.create(user=self.other_user, currency=self.btc, amount=1)
+        response = self.client.get(f"/orders/{order.pk}/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get("/orders/").json()["results"], [])
+
+
+class HTTPExchangeTestCase(TestCase):
+    def setUp(self):
+        self.server = MockExchangeServer(seed=0)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.currency = Currency.objects.create(
+            display_name="Test Currency", ticker_symbol="TEST", dollar_value=10
+        )
+        self.exchange = Exchange.objects.create(
+            title="Mock", adapter=Exchange.Adapter.HTTP, url=self.server.url
+        )
+        self.delays = []
+
+    def http_client(self, url=None, **kwargs):
+        client = HTTPExchange(
+            url or self.server.url, sleep=self.delays.append, **kwargs
+        )
+        self.addCleanup(client.close)
+        return client
+
+    def test_buy_from_exchange(self):
+        self.exchange.buy_from_exchange(amount=3, symbol="TEST")
+        self.exchange.buy_from_exchange(amount=2, symbol="TEST")
+        self.assertEqual(TreasuryBalance.total(self.currency), 5)
+        self.assertEqual(len(self.server.orders), 2)
+        # Both orders went over the same keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+    def test_failed_attempts_are_retried(self):
+        self.server.failure_rate = 0.5
+        client = self.http_client(retries=10, backoff=0.1)
+        for _ in range(10):
+            self.assertEqual(client.buy("TEST", Decimal(1)), 1)
+        self.assertEqual(len(self.server.orders), 10)
+        self.assertGreater(self.server.requests, 10)
+        self.assertEqual(len(self.delays), self.server.requests - 10)
+        self.assertTrue(all(0 <= delay <= 0.1 * 2**9 for delay in self.delays))
+
+    def test_circuit_breaker(self):
+        self.server.failure_rate = 1
+        now = [0]
+        breaker = CircuitBreaker(threshold=3, reset_timeout=30, clock=lambda: now[0])
+        client = self.http_client(retries=1, breaker=breaker)
+        with self.assertRaises(ExchangeError):
+            client.buy("TEST", Decimal(1))
+        with self.assertRaises(ExchangeUnavailable):
+            client.buy("TEST", Decimal(1))
+        self.assertEqual(self.server.requests, 3)
+
+        # After the reset timeout one probe gets through, and closes the breaker
+        self.server.failure_rate = 0
+        now[0] = 30
+        self.assertEqual(client.buy("TEST", Decimal(1)), 1)
+        self.assertFalse(breaker.is_open)
+
+    def test_unreachable_exchange(self):
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            url = "http://127.0.0.1:{}".format(unused.getsockname()[1])
+        with self.assertRaises(ExchangeError):
+            self.http_client(url, retries=2, timeout=1).buy("TEST", Decimal(1))
+        self.assertEqual(len(self.delays), 2)
+
+
+class QuoteTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=20000
+        )
+        self.usd_balance = UserBalance.objects.create(
+            user=self.user, currency=usd, amount=10000
+        )
+        Exchange.objects.create(title="Binance")
+        self.client.force_login(self.user)
+
+    def quote(self, amount="0.25"):
+        response = self.client.post("/quote/", {"symbol": "BTC", "amount": amount})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.json()
+
+    def test_quote_is_filled_at_its_price(self):
+        quote = self.quote()
+        self.assertEqual(quote["rate"], "20000.000000")
+        self.assertEqual(quote["total"], "5000.000000")
+
+        # The price changes after the quote
+        self.btc.dollar_value = 30000
+        self.btc.save()
+
+        with self.assertNumQueries(0):
+            Quote.load(quote["quote"], self.user)
+        response = self.client.post("/buy/", {"quote": quote["quote"]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.usd_balance.refresh_from_db()
+        self.assertEqual(self.usd_balance.amount, 5000)
+        self.assertEqual(
+            UserBalance.objects.get(user=self.user, currency=self.btc).amount,
+            Decimal("0.25"),
+        )
+
+    def test_invalid_quotes(self):
+        token = self.quote()["quote"]
+        other_user = User.objects.create_user(
+            username="otheruser", password="testpassword"
+        )
+        with self.assertRaises(InvalidQuote):
+            Quote.load(token, other_user)
+
+        response = self.client.post("/buy/", {"quote": token.replace(":", "0:", 1)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with override_settings(QUOTE_TTL=-1):
+            response = self.client.post("/buy/", {"quote": token})
+        self.assertEqual(response.json(), {"error": "Quote has expired."})
+
+    def test_insufficient_funds(self):
+        quote = self.quote("1")
+        response = self.client.post("/buy/", {"quote": quote["quote"]})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # A failed fill doesn't use the quote up
+        self.usd_balance.increase_amount(20000)
+        response = self.client.post("/buy/", {"quote": quote["quote"]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_quote_is_filled_once(self):
+        token = self.quote()["quote"]
+        response = self.client.post("/buy/", {"quote": token})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.post("/buy/", {"quote": token})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {"error": "Quote was already used."})
+        self.usd_balance.refresh_from_db()
+        self.assertEqual(self.usd_balance.amount, 5000)
+
+        # Quotes for the same purchase are distinct
+        self.assertNotEqual(self.quote()["quote"], token)
+
+
+class PriceSheetTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            username="admin", password="testpassword"
+        )
+        Currency.objects.bulk_create(
+            [
+                Currency(
+                    display_name=f"Coin {i}", ticker_symbol=f"C{i}", dollar_value=1
+                )
+                for i in range(50)
+            ]
+        )
+        self.client.force_login(self.admin)
+
+    def test_json_sheet(self):
+        version = PriceVersion.current()
+        currency_cache.get("C1")
+        prices = [
+            {"ticker_symbol": f"C{i}", "dollar_value": str(i + 1)} for i in range(50)
+        ]
+        response = self.client.post(
+            "/currencies/prices/", prices, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # C0 already had that price
+        self.assertEqual(response.json(), {"version": version + 1, "updated": 49})
+        self.assertEqual(currency_cache.get("C1").dollar_value, 2)
+        self.assertEqual(
+            set(
+                Currency.objects.exclude(ticker_symbol="C0").values_list(
+                    "price_version", flat=True
+                )
+            ),
+            {version + 1},
+        )
+
+    def test_csv_sheet(self):
+        response = self.client.post(
+            "/currencies/prices/",
+            "ticker_symbol,dollar_value\nC1,2.5\nC2,30000\n",
+            content_type="text/csv",
+        )
+        self.assertEqual(response.json()["updated"], 2)
+        self.assertEqual(
+            Currency.objects.get(ticker_symbol="C2").dollar_value, Decimal("30000")
+        )
+
+    def test_query_count_does_not_grow(self):
+        def update(count, price):
+            sheet = "ticker_symbol,dollar_value\n" + "".join(
+                f"C{i},{price}\n" for i in range(count)
+            )
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post("/currencies/prices/", sheet, content_type="text/csv")
+            return len(queries)
+
+        update(1, 2)  # Creates the PriceVersion row
+        self.assertEqual(update(5, 3), update(50, 4))
+
+    def test_whole_sheet_is_rejected(self):
+        response = self.client.post(
+            "/currencies/prices/",
+            "ticker_symbol,dollar_value\nC1,2\nNOPE,3\n",
+            content_type="text/csv",
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json()["symbols"], ["NOPE"])
+        self.assertEqual(Currency.objects.get(ticker_symbol="C1").dollar_value, 1)
+
+        response = self.client.post(
+            "/currencies/prices/",
+            "ticker_symbol,dollar_value\nC1,0\n",
+            content_type="text/csv",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_save_stamps_price_version(self):
+        currency = Currency.objects.get(ticker_symbol="C1")
+        currency.dollar_value = 5
+        currency.save()
+        self.assertEqual(currency.price_version, PriceVersion.current())
+        currency.refresh_from_db()
+        self.assertEqual(currency.price_version, PriceVersion.current())
+
+    def test_price_version_follows_the_price(self):
+        currency = Currency.objects.get(ticker_symbol="C1")
+        currency.dollar_value = 5
+        bump = PriceVersion.bump
+        prices = []
+
+        def record():
+            prices.append(Currency.objects.get(pk=currency.pk).dollar_value)
+            return bump()
+
+        with mock.patch.object(PriceVersion, "bump", record):
+            currency.save()
+        self.assertEqual(prices, [Decimal(5)])
+
+
+class IdempotencyKeyTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=10
+        )
+        self.usd_balance = UserBalance.objects.create(
+            user=self.user, currency=usd, amount=25
+        )
+        Exchange.objects.create(title="Binance")
+        self.client.force_login(self.user)
+        idempotency_cache.clear()
+
+    def buy(self, key, amount="1"):
+        return self.client.post(
+            "/buy/", {"symbol": "BTC", "amount": amount}, HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_is_replayed(self):
+        response = self.buy("first")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", response)
+
+        retry = self.buy("first")
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.json(), response.json())
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.usd_balance.refresh_from_db()
+        self.assertEqual(self.usd_balance.amount, 15)
+
+        # A new key is a new purchase
+        self.assertEqual(self.buy("second").status_code, status.HTTP_201_CREATED)
+        self.usd_balance.refresh_from_db()
+        self.assertEqual(self.usd_balance.amount, 5)
+
+    def test_failures_are_replayed(self):
+        self.assertEqual(self.buy("big", "3").status_code, status.HTTP_403_FORBIDDEN)
+        self.usd_balance.increase_amount(100)
+        self.assertEqual(self.buy("big", "3").status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_async_retry_is_replayed(self):
+        def accept():
+            return self.client.post(
+                "/buy/",
+                {"symbol": "BTC", "amount": "1"},
+                HTTP_PREFER="respond-async",
+                HTTP_IDEMPOTENCY_KEY="async",
+            )
+
+        response = accept()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        retry = accept()
+        self.assertEqual(retry.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry["Location"], response["Location"])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_server_errors_are_rolled_back(self):
+        request = SimpleNamespace(
+            headers={"Idempotency-Key": "broken"},
+            user=self.user,
+            path="/buy/",
+            data={},
+        )
+
+        def handle():
+            self.usd_balance.decrease_amount(10)
+            return {"error": "An error occurred."}, 500
+
+        response = Buy().idempotent(request, handle)
+        self.assertEqual(response.status_code, 500)
+        self.usd_balance.refresh_from_db()
+        self.assertEqual(self.usd_balance.amount, 25)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_lookup_from_database(self):
+        self.buy("first")
+        idempotency_cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                IdempotencyKey.lookup(self.user, "first").status_code,
+                status.HTTP_201_CREATED,
+            )
+        with self.assertNumQueries(0):
+            IdempotencyKey.lookup(self.user, "first")
+
+    def test_key_reused_for_other_request(self):
+        self.buy("first")
+        response = self.buy("first", "2")
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_expired_keys(self):
+        self.buy("first")
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        self.assertEqual(IdempotencyKey.sweep(), 1)
+
+        # An expired key that wasn't swept yet is not replayed either
+        self.assertEqual(self.buy("second").status_code, status.HTTP_201_CREATED)
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        response = self.buy("second")
+        self.assertNotIn("Idempotent-Replayed", response)
+        # Handled again, and this time there are no funds left
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(TREASURY_REPLENISH_INLINE=True)
+class IdempotentReplenishTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=10
+        )
+        UserBalance.objects.create(user=self.user, currency=usd, amount=100)
+        Exchange.objects.create(title="Binance")
+        self.client.force_login(self.user)
+        idempotency_cache.clear()
+        currency_cache.clear()
+        self.addCleanup(currency_cache.clear)
+
+        self.in_transaction = []
+        purchase_if_necessary = TreasuryPurchaceHandler.purchase_if_necessary
+
+        def record(handler, exchange):
+            self.in_transaction.append(connection.in_atomic_block)
+            return purchase_if_necessary(handler, exchange)
+
+        patcher = mock.patch.object(
+            TreasuryPurchaceHandler, "purchase_if_necessary", record
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keyed_buy_replenishes_after_commit(self):
+        response = self.client.post(
+            "/buy/", {"symbol": "BTC", "amount": "1"}, HTTP_IDEMPOTENCY_KEY="one"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.in_transaction, [False])
+        self.assertEqual(TreasuryBalance.total(self.btc), 0)
+
+    def test_keyed_batch_replenishes_after_commit(self):
+        response = self.client.post(
+            "/buy/batch/",
+            [{"symbol": "BTC", "amount": "1"}],
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY="batch",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.in_transaction, [False])
+
+
+class PortfolioTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", password="testpassword"
+        )
+        self.other_user = User.objects.create_user(
+            username="otheruser", password="testpassword"
+        )
+        usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value="25000.5"
+        )
+        UserBalance.objects.create(user=self.user, currency=usd, amount=100)
+        UserBalance.objects.create(user=self.user, currency=btc, amount="0.5")
+        UserBalance.objects.create(user=self.other_user, currency=btc, amount=2)
+        TreasuryBalance.objects.create(currency=btc, amount=3)
+        LedgerEntry.objects.create(currency=btc, amount=-1)
+        self.client.force_login(self.user)
+
+    def test_portfolio(self):
+        with self.assertNumQueries(1):
+            value = Portfolio(UserBalance, user=self.user).value()
+        self.assertEqual(value["total_usd"], Decimal("12600.25"))
+
+        # Session and user lookups, then the valuation
+        with self.assertNumQueries(3):
+            response = self.client.get("/portfolio/")
+        self.assertEqual(
+            response.json(),
+            {
+                "holdings": [
+                    {
+                        "symbol": "BTC",
+                        "amount": "0.500000",
+                        "dollar_value": "25000.500000",
+                        "usd_value": "12500.250000",
+                    },
+                    {
+                        "symbol": "USD",
+                        "amount": "100.000000",
+                        "dollar_value": "1.000000",
+                        "usd_value": "100.000000",
+                    },
+                ],
+                "total_usd": "12600.250000",
+            },
+        )
+
+    def test_treasury_includes_recent_entries(self):
+        self.assertEqual(
+            self.client.get("/treasury/").status_code, status.HTTP_403_FORBIDDEN
+        )
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get("/treasury/")
+        self.assertEqual(response.json()["holdings"][0]["amount"], "2.000000")
+        self.assertEqual(response.json()["total_usd"], "50001.000000")
+
+    def test_many_users_in_one_query(self):
+        with self.assertNumQueries(1):
+            values = Portfolio.of_users()
+        self.assertEqual(values[self.user.pk]["total_usd"], Decimal("12600.25"))
+        self.assertEqual(values[self.other_user.pk]["total_usd"], Decimal("50001"))
+
+    @override_settings(PORTFOLIO_CACHE_TTL=60)
+    def test_cache(self):
+        self.addCleanup(cache.clear)
+        portfolio = Portfolio(UserBalance, user=self.user)
+        portfolio.value()
+        with self.assertNumQueries(0):
+            self.assertEqual(portfolio.value()["total_usd"], Decimal("12600.25"))
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            username="admin", password="testpassword"
+        )
+        joined = timezone.now()
+        # Users that joined at the same moment are told apart by id
+        User.objects.bulk_create(
+            [User(username=f"user{i}", date_joined=joined) for i in range(24)]
+        )
+        self.client.force_login(self.admin)
+
+    def test_users_are_paged_by_cursor(self):
+        usernames = []
+        url = "/users/?page_size=10"
+        while url:
+            # Session, user, the page and the groups of its users
+            with self.assertNumQueries(4):
+                page = self.client.get(url).json()
+            self.assertLessEqual(len(page["results"]), 10)
+            usernames += [user["username"] for user in page["results"]]
+            url = page["next"]
+        self.assertCountEqual(
+            usernames, User.objects.values_list("username", flat=True)
+        )
+
+    def test_deep_pages_seek_instead_of_skipping(self):
+        page = self.client.get("/users/?page_size=10").json()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(page["next"])
+        sql = queries[2]["sql"]
+        self.assertIn('"auth_user"."date_joined" <=', sql)
+        self.assertNotIn("OFFSET", sql)
+
+    def test_previous_page(self):
+        first = self.client.get("/users/?page_size=10").json()
+        second = self.client.get(first["next"]).json()
+        self.assertEqual(self.client.get(second["previous"]).json(), first)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/users/?cursor=bm9wZQ==")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TreasuryLedgerTestCase(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username=f"user{i}", password="testpassword")
+            for i in range(4)
+        ]
+        self.usd = Currency.objects.create(
+            display_name="US Dollar", ticker_symbol="USD", dollar_value=1
+        )
+        self.btc = Currency.objects.create(
+            display_name="Bitcoin", ticker_symbol="BTC", dollar_value=10
+        )
+        for user in self.users:
+            UserBalance.objects.create(user=user, currency=self.usd, amount=100)
+        self.exchange = Exchange.objects.create(title="Binance")
+
+    def test_buys_only_append_to_the_ledger(self):
+        for user in self.users[:2]:
+            PurchaceHandler(user, "BTC", Decimal(1), self.exchange).execute()
+        BatchPurchaceHandler(
+            None,
+            [{"symbol": "BTC", "amount": 1, "user": user} for user in self.users[2:]],
+            self.exchange,
+        ).execute()
+        self.assertFalse(TreasuryBalance.objects.exists())
+        self.assertEqual(TreasuryBalance.total(self.btc), -4)
+        self.assertEqual(TreasuryBalance.total(self.usd), 40)
+
+        # Compaction folds the entries into the rows, the holdings don't change
+        LedgerSnapshot.compact(older_than=0)
+        self.assertEqual(
+            list(
+                TreasuryBalance.objects.order_by("currency").values_list(
+                    "amount", flat=True
+                )
+            ),
+            [40, -4],
+        )
+        self.assertEqual(TreasuryBalance.total(self.btc), -4)
+        self.assertEqual(TreasuryBalance.total(self.usd), 40)
+        self.assertEqual([row["total"] for row in TreasuryBalance.holdings()], [-4, 40])
+
+    def test_debt_is_checked_on_the_holding(self):
+        # A negative entry is no debt as long as the holding is positive
+        TreasuryBalance.objects.create(currency=self.btc, amount=5)
+        LedgerEntry.objects.create(currency=self.btc, amount=-3)
+        replenisher = TreasuryReplenisher(self.exchange, flush_value=0, max_wait=0)
+        self.assertEqual(replenisher.run_once(), [])
+
+        LedgerEntry.objects.create(currency=self.btc, amount=-4)
+        self.assertEqual(replenisher.run_once(), [("BTC", 2)])
+        self.assertEqual(TreasuryBalance.total(self.btc), 0)
+
+
+@contextmanager
+def file_database(alias="file", migrate_to=()):
+    """A migrated, file backed SQLite database, so threads can share it.
+
+    `migrate_to` is an (app, migration) pair to stop at.
+    """
+    directory = tempfile.mkdtemp()
+    connections.settings[alias] = {
+        **connections.settings["default"],
+        "NAME": os.path.join(directory, "db.sqlite3"),
+    }
+    try:
+        call_command("migrate", *migrate_to, database=alias, verbosity=0)
+        yield alias
+    finally:
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+        shutil.rmtree(directory)
+
+
+@contextmanager
+def default_database(alias):
+    """Points this thread's default connection at `alias`, see `file_database`.
+
+    Handlers run their queries and transactions on the default database, and
+    connections are per thread.
+    """
+    connections["default"] = connections.create_connection(alias)
+    try:
+        yield
+    finally:
+        connections["default"].close()
+        del connections["default"]
+
+
+class ConcurrentWriterTestCase(TransactionTestCase):
+    def test_concurrent_writers_do_not_lock(self):
+        with file_database() as alias:
+            currency = Currency.objects.using(alias).create(
+                display_name="Test Currency", ticker_symbol="TEST", dollar_value=1
+            )
+            TreasuryBalance.objects.using(alias).create(currency=currency, amount=0)
+            errors = []
+
+            def write():
+                balances = TreasuryBalance.objects.using(alias).filter(
+                    currency=currency
+                )
+                try:
+                    for _ in range(25):
+                        with transaction.atomic(using=alias):
+                            # Reading first is what makes deferred transactions fail
+                            balances.get()
+                            balances.update(amount=F("amount") + to_units(1))
+                except OperationalError as e:
+                    errors.append(e)
+                finally:
+                    connections[alias].close()
+
+            threads = [threading.Thread(target=write) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(
+                TreasuryBalance.objects.using(alias).get().amount, Decimal(200)
+            )
+            with connections[alias].cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                self.assertEqual(cursor.fetchone()[0], "wal")
+
+
+class LedgerMigrationTestCase(TransactionTestCase):
+    def test_existing_balances_are_counted_once(self):
+        before_ledger = ("core", "0004_priceversion")
+        with file_database(migrate_to=before_ledger) as alias:
+            apps = (
+                MigrationExecutor(connections[alias])
+                .loader.project_state(before_ledger)
+                .apps
+            )
+            user = (
+                apps.get_model("auth", "User")
+                .objects.using(alias)
+                .create(username="old")
+            )
+            old_currency = (
+                apps.get_model("core", "Currency")
+                .objects.using(alias)
+                .create(display_name="US Dollar", ticker_symbol="USD", dollar_value=1)
+            )
+            apps.get_model("core", "UserBalance").objects.using(alias).create(
+                user=user, currency=old_currency, amount=100
+            )
+            apps.get_model("core", "TreasuryBalance").objects.using(alias).create(
+                currency=old_currency, amount=1000
+            )
+
+            call_command("migrate", database=alias, verbosity=0)
+            with default_database(alias):
+                usd = Currency.objects.get()
+                user = User.objects.get()
+                self.assertEqual(TreasuryBalance.total(usd), 1000)
+                self.assertEqual(LedgerEntry.balance_of(usd), 1000)
+                self.assertEqual(LedgerEntry.balance_of(usd, user), 100)
+
+                TransferHandler(user=user, currency=usd).transfer_from_user_to_treasury(
+                    10
+                )
+                LedgerSnapshot.compact(older_than=0)
+                self.assertEqual(TreasuryBalance.total(usd), 1010)
+                self.assertEqual(TreasuryBalance.objects.get().amount, 1010)
+                self.assertEqual(LedgerEntry.balance_of(usd), 1010)
+                self.assertEqual(LedgerEntry.balance_of(usd, user), 90)
+
+    def test_treasury_stripes_are_folded(self):
+        with_stripes = ("core", "0016_ledger_watermark")
+        with file_database(migrate_to=with_stripes) as alias:
+            apps = (
+                MigrationExecutor(connections[alias])
+                .loader.project_state(with_stripes)
+                .apps
+            )
+            currency = (
+                apps.get_model("core", "Currency")
+                .objects.using(alias)
+                .create(display_name="Bitcoin", ticker_symbol="BTC", dollar_value=10)
+            )
+            apps.get_model("core", "TreasuryBalance").objects.using(alias).bulk_create(
+                [
+                    apps.get_model("core", "TreasuryBalance")(
+                        currency=currency, stripe=stripe, amount=amount
+                    )
+                    for stripe, amount in [(1, 5), (3, -2)]
+                ]
+            )
+
+            call_command("migrate", database=alias, verbosity=0)
+            self.assertEqual(
+                TreasuryBalance.objects.using(alias).get().amount, Decimal(3)
+            )
+
+
+@override_settings(TREASURY_REPLENISH_INLINE=True)
+class BuyStressTestCase(TransactionTestCase):
+    """Thousands of buys from many threads, then checks nothing was lost.
+
+    Every user starts without a balance of the currency being bought, and
+    the treasury without any, so the first buys race to create the rows.
+    """
+
+    buys = 2000
+    workers = 8
+    users = 16
+    # Buys per second, far below what SQLite does; a regression that
+    # serializes buys behind lock timeouts falls under it
+    minimum_throughput = 50
+
+    def setUp(self):
+        currency_cache.clear()
+        self.addCleanup(currency_cache.clear)
+        self.server = MockExchangeServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def seed(self, alias):
+        self.usd, self.btc, self.eth = Currency.objects.using(alias).bulk_create(
+            [
+                Currency(display_name="US Dollar", ticker_symbol="USD", dollar_value=1),
+                Currency(
+                    display_name="Bitcoin", ticker_symbol="BTC", dollar_value=20000
+                ),
+                Currency(display_name="Ether", ticker_symbol="ETH", dollar_value=2000),
+            ]
+        )
+        self.accounts = User.objects.using(alias).bulk_create(
+            [User(username=f"stress-{i}") for i in range(self.users)]
+        )
+        # Enough for most buys, not all of them: the funds check runs too
+        UserBalance.objects.using(alias).bulk_create(
+            [
+                UserBalance(user=user, currency=self.usd, amount=1500)
+                for user in self.accounts
+            ]
+            + [
+                UserBalance(user=user, currency=self.btc, amount=Decimal("0.04"))
+                for user in self.accounts
+            ]
+        )
+        TreasuryBalance.objects.using(alias).create(currency=self.usd, amount=0)
+        TreasuryBalance.objects.using(alias).create(currency=self.btc, amount=0)
+        Exchange.objects.using(alias).create(
+            title="Mock", adapter=Exchange.Adapter.HTTP, url=self.server.url
+        )
+
+    def orders(self):
+        """(user id, orders) per buy, a tenth of them batches of three orders."""
+        orders = []
+        for i in range(self.buys):
+            order = {"symbol": "ETH", "amount": Decimal("0.01")}
+            if i % 3 == 1:
+                order["pay_with"] = "BTC"
+            if i % 10 == 0:
+                order = [order, {"symbol": "ETH", "amount": Decimal("0.01")}, order]
+            orders.append((self.accounts[i % self.users].pk, order))
+        return orders
+
+    def run_buys(self, alias, orders):
+        """Fills `orders` from `workers` threads, returns statuses and seconds."""
+        statuses = Counter()
+        errors = []
+        lock = threading.Lock()
+
+        def work(chunk):
+            results = Counter()
+            with default_database(alias):
+                # Loaded per thread, like a request would
+                users = User.objects.in_bulk()
+                exchange = Exchange.objects.get()
+                for user_id, order in chunk:
+                    user = users[user_id]
+                    try:
+                        if isinstance(order, list):
+                            data, _ = BatchPurchaceHandler(
+                                user, order, exchange
+                            ).execute()
+                            results.update(result["status"] for result in data)
+                        else:
+                            handler = PurchaceHandler(
+                                user,
+                                order["symbol"],
+                                order["amount"],
+                                exchange,
+                                pay_with=order.get("pay_with"),
+                            )
+                            results[handler.execute()[1]] += 1
+                    except Exception as e:
+                        errors.append(e)
+            with lock:
+                statuses.update(results)
+
+        threads = [
+            threading.Thread(target=work, args=(orders[i :: self.workers],))
+            for i in range(self.workers)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return statuses, time.perf_counter() - started
+
+    def totals(self, model, alias, **lookup):
+        return dict(
+            model.objects.using(alias)
+            .filter(**lookup)
+            .values_list("currency__ticker_symbol")
+            .annotate(total=Sum("amount"))
+        )
+
+    def treasury(self, alias):
+        """Treasury holdings, rows and recent ledger entries, see `TreasuryBalance`."""
+        return dict(
+            Currency.objects.using(alias)
+            .annotate(total=TreasuryBalance.holding())
+            .values_list("ticker_symbol", "total")
+        )
+
+    def test_buys_conserve_balances(self):
+        with file_database() as alias:
+            self.seed(alias)
+            before = Counter(self.totals(UserBalance, alias))
+            before.update(self.treasury(alias))
+            opening = {"USD": 1500, "BTC": Decimal("0.04"), "ETH": 0}
+
+            statuses, elapsed = self.run_buys(alias, self.orders())
+
+            # Every order either went through or was refused for lack of funds
+            self.assertEqual(set(statuses), {201, 403})
+            self.assertGreater(statuses[201], statuses[403])
+
+            # Users and the treasury only trade with each other, what the
+            # exchange filled is all that came in
+            filled = Counter()
+            for order in self.server.orders.values():
+                filled[order["symbol"]] += Decimal(order["filled"])
+            self.assertGreater(filled["ETH"], 0)
+            after = Counter(self.totals(UserBalance, alias))
+            after.update(self.treasury(alias))
+            for symbol in ("USD", "BTC", "ETH"):
+                self.assertEqual(after[symbol], before[symbol] + filled[symbol])
+
+            # No buy was lost or counted twice
+            self.assertEqual(
+                self.totals(UserBalance, alias)["ETH"],
+                statuses[201] * Decimal("0.01"),
+            )
+            self.assertFalse(
+                UserBalance.objects.using(alias).filter(amount__lt=0).exists()
+            )
+
+            # Balances and the ledger agree, account by account
+            changes = Counter(
+                {
+                    (user, symbol): amount
+                    for user, symbol, amount in LedgerEntry.objects.using(alias)
+                    .values_list("user", "currency__ticker_symbol")
+                    .annotate(total=Sum("amount"))
+                }
+            )
+            for user, symbol, amount in UserBalance.objects.using(alias).values_list(
+                "user", "currency__ticker_symbol", "amount"
+            ):
+                self.assertEqual(amount, opening[symbol] + changes[user, symbol])
+            treasury = self.treasury(alias)
+            for symbol in ("USD", "BTC", "ETH"):
+                self.assertEqual(treasury[symbol], changes[None, symbol])
+
+            throughput = statuses.total() / elapsed
+            print(
+                f"\n{type(self).__name__}: {statuses.total()} orders from "
+                f"{self.workers} threads in {elapsed:.2f}s, {throughput:.0f}/s",
+                file=sys.stderr,
+            )
+            self.assertGreater(throughput, self.minimum_throughput)
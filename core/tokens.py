@@ -0,0 +1,93 @@
+"""Signed API tokens.
+
+A token names a user and is signed with `SECRET_KEY`, like a quote (see
+`core.quotes`), so it needs no storage and is checked without a query. The
+users behind recent tokens are kept in memory for `API_TOKEN_USER_TTL`
+seconds: requests sent with a token skip the session and user lookups, and
+the CSRF check that comes with session authentication.
+
+A token stops working when it expires, or within `API_TOKEN_USER_TTL`
+seconds of its user changing their password or being deactivated.
+"""
+
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from rest_framework import authentication, exceptions
+
+from core.models import LRUCache
+
+User = get_user_model()
+
+SALT = "core.tokens"
+KEYWORD = "Bearer"
+
+
+class InvalidToken(ValueError):
+    """Raised for tampered or expired tokens, and tokens of disabled users."""
+
+
+# user id -> (user, its password fingerprint, when to load it again)
+user_cache = LRUCache(settings.API_TOKEN_CACHE_SIZE)
+
+
+def _fingerprint(user) -> str:
+    # Changes with the password, which logs out every session too
+    return user.get_session_auth_hash()[:16]
+
+
+def issue(user) -> str:
+    return signing.dumps([user.pk, _fingerprint(user)], salt=SALT)
+
+
+def load(token: str):
+    """Returns the user of a token made by `issue`."""
+    try:
+        user_id, fingerprint = signing.loads(
+            token, salt=SALT, max_age=settings.API_TOKEN_TTL
+        )
+    except signing.SignatureExpired:
+        raise InvalidToken("Token has expired.")
+    except (signing.BadSignature, TypeError, ValueError):
+        raise InvalidToken("Invalid token.")
+
+    entry = user_cache.get(user_id)
+    if entry is None or entry[2] < time.monotonic():
+        try:
+            user = User.objects.get(pk=user_id, is_active=True)
+        except User.DoesNotExist:
+            user_cache.discard(user_id)
+            raise InvalidToken("Invalid token.")
+        entry = (
+            user,
+            _fingerprint(user),
+            time.monotonic() + settings.API_TOKEN_USER_TTL,
+        )
+        user_cache.add(user_id, entry)
+
+    user, current_fingerprint, _ = entry
+    if fingerprint != current_fingerprint:
+        raise InvalidToken("Invalid token.")
+    return user
+
+
+class SignedTokenAuthentication(authentication.BaseAuthentication):
+    """Authenticates `Authorization: Bearer <token>` requests, see `issue`."""
+
+    def authenticate(self, request):
+        auth = authentication.get_authorization_header(request).split()
+        if not auth or auth[0].lower() != KEYWORD.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed("Invalid token header.")
+        try:
+            return load(auth[1].decode()), auth[1]
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed("Invalid token header.")
+        except InvalidToken as e:
+            raise exceptions.AuthenticationFailed(str(e))
+
+    def authenticate_header(self, request):
+        return KEYWORD
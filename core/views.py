@@ -1,16 +1,55 @@
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import User
-from rest_framework import permissions, status, viewsets
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from rest_framework import exceptions, permissions, status, viewsets
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from core.models import Currency, Exchange, UserBalance
+from core import metrics, tokens
+from core.exports import EXPORTS, aiterate, gzip_stream
+from core.parsers import CSVParser
+from core.renderers import CSVRenderer, JSONLinesRenderer
+from core.quotes import InvalidQuote, Quote
+from core.models import (
+    Currency,
+    Exchange,
+    IdempotencyKey,
+    Order,
+    TreasuryBalance,
+    UserBalance,
+    currency_cache,
+)
 from core.serializers import (
     CurrencyExchangeSerializer,
     CurrencySerializer,
+    OrderSerializer,
+    PortfolioSerializer,
+    PriceSerializer,
+    QuotedBuySerializer,
+    QuoteSerializer,
     UserSerializer,
 )
-from core.utils import PurchaceHandler
+from core.utils import (
+    AsyncPurchaceHandler,
+    BatchPurchaceHandler,
+    Portfolio,
+    PriceSheetHandler,
+    PurchaceHandler,
+    QuotedPurchaceHandler,
+)
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -18,7 +57,9 @@ class UserViewSet(viewsets.ModelViewSet):
     API endpoint that allows users to be viewed or edited.
     """
 
-    queryset = User.objects.all().order_by("-date_joined")
+    queryset = User.objects.prefetch_related("groups")
+    # Backed by core_user_joined_idx, see core/migrations/0010
+    ordering = ("-date_joined", "-id")
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAdminUser]
 
@@ -29,9 +70,42 @@ class CurrencyViewSet(viewsets.ModelViewSet):
     """
 
     queryset = Currency.objects.all()
+    ordering = ("ticker_symbol",)
     serializer_class = CurrencySerializer
     permission_classes = [permissions.IsAdminUser]
 
+    @action(
+        detail=False,
+        methods=["post"],
+        parser_classes=[JSONParser, CSVParser],
+        serializer_class=PriceSerializer,
+    )
+    def prices(self, request):
+        """Updates many prices at once, eg. a CSV with `ticker_symbol,dollar_value` lines.
+
+        JSON sheets are a list of `{"ticker_symbol": ..., "dollar_value": ...}`.
+        """
+        serializer = PriceSerializer(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=settings.MAXIMUM_PRICE_SHEET_LINES,
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        prices = {
+            line["ticker_symbol"]: line["dollar_value"]
+            for line in serializer.validated_data
+        }
+        if len(prices) < len(serializer.validated_data):
+            return Response(
+                {"error": "Duplicate ticker symbols."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        data, response_status = PriceSheetHandler(prices).execute()
+        return Response(data, status=response_status)
+
 
 class Buy(viewsets.ViewSet):
     serializer_class = CurrencyExchangeSerializer
@@ -42,39 +116,357 @@ class Buy(viewsets.ViewSet):
         return Response(data)
 
     def post(self, request):
+        if "quote" in request.data:
+            return self.buy_quote(request)
+
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             validated_data = serializer.validated_data
             requested_symbol = validated_data.get("symbol")
             requested_amount = validated_data.get("amount")
-            # DRF handles 404 errors
-            requested_currency = Currency.objects.get(ticker_symbol=requested_symbol)
-            base_currency = Currency.objects.get(
-                ticker_symbol=settings.BASE_CURRENCY_SYMBOL
-            )
-            user_base_balance, _ = UserBalance.objects.get_or_create(
-                user=request.user, currency=base_currency
-            )
-
-            required_funds = requested_currency.dollar_value * requested_amount
+            pay_with = validated_data.get("pay_with")
+            if "respond-async" in request.headers.get("Prefer", ""):
+                if pay_with:
+                    return Response(
+                        {"error": "Asynchronous orders are paid in USD."},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+                response = self.idempotent(
+                    request,
+                    lambda: self.accept(request, requested_symbol, requested_amount),
+                )
+                if response.status_code == status.HTTP_202_ACCEPTED:
+                    response["Location"] = response.data["url"]
+                return response
 
-            if required_funds > user_base_balance.in_dollars:
-                return Response(
-                    {"error": "Insufficient Funds!"}, status=status.HTTP_403_FORBIDDEN
+            # Funds are checked by PurchaceHandler, inside the transfer itself.
+            def purchase():
+                exchange = Exchange.objects.get()
+                handler = PurchaceHandler(
+                    request.user,
+                    requested_symbol,
+                    requested_amount,
+                    exchange,
+                    pay_with=pay_with,
                 )
+                return handler.execute()
+
+            try:
+                return self.idempotent(request, purchase)
+            except Exception as e:
+                print(e)
+                return Response("Error!", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def buy_quote(self, request):
+        """Buys at the price of a quote from `/quote/`, `{"quote": "<token>"}`."""
+        serializer = QuotedBuySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            quote = Quote.load(serializer.validated_data["quote"], request.user)
+        except InvalidQuote as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        def purchase():
+            exchange = Exchange.objects.get()
+            return QuotedPurchaceHandler(request.user, quote, exchange).execute()
 
-            else:
-                try:
-                    exchange = Exchange.objects.get()
-                    handler = PurchaceHandler(
-                        request.user, requested_symbol, requested_amount, exchange
+        try:
+            return self.idempotent(request, purchase)
+        except Exception as e:
+            print(e)
+            return Response("Error!", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def idempotent(self, request, handle):
+        """Runs `handle` once per `Idempotency-Key`, replaying its response to retries.
+
+        `handle` returns `(data, status)`. Its changes and the stored response
+        are committed together, so a retry racing the original either sees the
+        response or has its own changes rolled back. Server errors aren't
+        stored, those may be retried, so their changes are rolled back too.
+        Handlers replenish the treasury once this has committed, see
+        `PurchaceHandler.replenish`.
+        """
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            data, response_status = handle()
+            return Response(data, status=response_status)
+        if len(key) > IdempotencyKey._meta.get_field("key").max_length:
+            return Response(
+                {"error": "Idempotency-Key is too long."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        fingerprint = hashlib.sha256(
+            json.dumps(
+                [request.path, request.data], sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+        stored = IdempotencyKey.lookup(request.user, key)
+        if stored is None:
+            try:
+                with transaction.atomic():
+                    data, response_status = handle()
+                    if response_status >= 500:
+                        transaction.set_rollback(True)
+                        return Response(data, status=response_status)
+                    IdempotencyKey.store(
+                        request.user, key, fingerprint, response_status, data
                     )
-                    handler.execute()
-                except Exception as e:
-                    print(e)
+                return Response(data, status=response_status)
+            except IntegrityError:
+                # A concurrent request with the same key committed first
+                stored = IdempotencyKey.lookup(request.user, key)
+                if stored is None:
                     return Response(
-                        "Error!", status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                        {
+                            "error": "A request with this Idempotency-Key is in progress."
+                        },
+                        status=status.HTTP_409_CONFLICT,
                     )
-            return Response("OK.", status=status.HTTP_201_CREATED)
+
+        if stored.fingerprint != fingerprint:
+            return Response(
+                {"error": "Idempotency-Key was used for a different request."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        return Response(
+            stored.response,
+            status=stored.status_code,
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    def accept(self, request, symbol, amount):
+        """Stores the order for `process_orders` to fill, returns `(data, status)`."""
+        try:
+            currency = currency_cache.get(symbol)
+        except Currency.DoesNotExist:
+            return {"error": "Currency not found."}, status.HTTP_404_NOT_FOUND
+        order = Order.objects.create(
+            user=request.user, currency=currency, amount=amount
+        )
+        data = OrderSerializer(order, context={"request": request}).data
+        return data, status.HTTP_202_ACCEPTED
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """Buy several currencies at once, eg. `[{"symbol": "BTC", "amount": 1}]`."""
+        serializer = self.serializer_class(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=settings.MAXIMUM_BATCH_ORDERS,
+        )
+        if serializer.is_valid():
+
+            def purchase():
+                exchange = Exchange.objects.get()
+                handler = BatchPurchaceHandler(
+                    request.user, serializer.validated_data, exchange
+                )
+                return handler.execute()
+
+            try:
+                return self.idempotent(request, purchase)
+            except Exception as e:
+                print(e)
+                return Response("Error!", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class QuoteViewSet(viewsets.ViewSet):
+    """
+    API endpoint that prices a purchase, the price holds for `QUOTE_TTL` seconds.
+    """
+
+    serializer_class = CurrencyExchangeSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        data = {"message": 'Get a quote, then buy it with POST /buy/ {"quote": ...}.'}
+        return Response(data)
+
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if serializer.validated_data.get("pay_with"):
+            return Response(
+                {"error": "Quotes are paid in USD."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            quote = Quote.issue(
+                request.user,
+                serializer.validated_data["symbol"],
+                serializer.validated_data["amount"],
+            )
+        except Currency.DoesNotExist:
+            return Response(
+                {"error": "Currency not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(QuoteSerializer(quote).data, status=status.HTTP_201_CREATED)
+
+
+class TokenViewSet(viewsets.ViewSet):
+    """
+    API endpoint that issues a signed API token for the user, to be sent as
+    `Authorization: Bearer <token>`. Authenticate with a username and
+    password (basic authentication) or a session. Not with a token, or a
+    leaked token could keep renewing itself.
+    """
+
+    authentication_classes = [BasicAuthentication, SessionAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def create(self, request):
+        return Response(
+            {
+                "token": tokens.issue(request.user),
+                "token_type": tokens.KEYWORD,
+                "expires_in": settings.API_TOKEN_TTL,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class OrderViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that allows users to follow the orders they placed.
+    """
+
+    serializer_class = OrderSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    ordering = ("-id",)
+
+    def get_queryset(self):
+        return Order.objects.filter(user=self.request.user).select_related("currency")
+
+
+class PortfolioViewSet(viewsets.ViewSet):
+    """
+    API endpoint that values the user's balances in USD.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        portfolio = Portfolio(UserBalance, user=request.user)
+        return Response(PortfolioSerializer(portfolio.value()).data)
+
+
+class TreasuryViewSet(viewsets.ViewSet):
+    """
+    API endpoint that allows admins to value the treasury in USD.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def list(self, request):
+        portfolio = Portfolio(TreasuryBalance)
+        return Response(PortfolioSerializer(portfolio.value()).data)
+
+
+class ExportViewSet(viewsets.ViewSet):
+    """
+    API endpoint that allows admins to download every balance, treasury
+    balance or transfer, as JSON lines or CSV (`?format=csv`). Rows are
+    streamed as they are read, gzipped for clients that accept it.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+    renderer_classes = [JSONLinesRenderer, CSVRenderer]
+
+    def retrieve(self, request, pk=None):
+        export = EXPORTS.get(pk)
+        if export is None:
+            raise exceptions.NotFound()
+
+        renderer = request.accepted_renderer
+        content = renderer.stream(list(export.fields), export.rows())
+        gzipped = bool(
+            re_accepts_gzip.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        )
+        if gzipped:
+            content = gzip_stream(content)
+        if isinstance(request._request, ASGIRequest):
+            content = aiterate(content)
+        response = StreamingHttpResponse(content)
+        if gzipped:
+            response["Content-Encoding"] = "gzip"
+        response["Content-Type"] = f"{renderer.media_type}; charset={renderer.charset}"
+        response["Content-Disposition"] = (
+            f'attachment; filename="{pk}.{renderer.format}"'
+        )
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
+
+
+def metrics_view(request):
+    """
+    Request and handler timings of this process, for Prometheus to scrape.
+    """
+    return HttpResponse(
+        metrics.render() + "\n", content_type="text/plain; version=0.0.4"
+    )
+
+
+def _authenticate(request):
+    """Runs DRF authentication and parsing, both of which may hit the database."""
+    drf_request = Request(
+        request,
+        parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+        authenticators=[
+            authenticator()
+            for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+        ],
+    )
+    return drf_request.user, drf_request.data
+
+
+async def buy_async(request):
+    """
+    Async variant of `Buy`, to be served by an ASGI worker.
+    """
+    try:
+        user, data = await sync_to_async(_authenticate)(request)
+    except exceptions.APIException as e:
+        return JsonResponse({"detail": e.detail}, status=e.status_code)
+    if not user.is_authenticated:
+        return JsonResponse(
+            {"detail": "Authentication credentials were not provided."},
+            status=status.HTTP_403_FORBIDDEN,
+        )
+
+    if request.method != "POST":
+        return JsonResponse({"message": "Buy a currency using USD."})
+
+    serializer = CurrencyExchangeSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        exchange = await Exchange.objects.aget()
+        handler = AsyncPurchaceHandler(
+            user,
+            serializer.validated_data["symbol"],
+            serializer.validated_data["amount"],
+            exchange,
+            pay_with=serializer.validated_data.get("pay_with"),
+        )
+        data, response_status = await handler.execute()
+    except Exception as e:
+        print(e)
+        return JsonResponse(
+            "Error!", status=status.HTTP_500_INTERNAL_SERVER_ERROR, safe=False
+        )
+    return JsonResponse(data, status=response_status)
+
+
+# SessionAuthentication enforces CSRF, like for the other endpoints.
+# (`csrf_exempt` only learnt to wrap async views in Django 5.0)
+buy_async.csrf_exempt = True